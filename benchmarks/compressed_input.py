@@ -0,0 +1,127 @@
+# Benchmark loading multi-year ameriflux data from plain and compressed
+# files on a slow (sftp) mount. The mount is simulated by reading the files
+# through a mirror_nmeg.Mirror that is throttled to a fixed bandwidth, so
+# each timing includes transfer of the file from the "mount" and parsing.
+#
+# usage: python compressed_input.py [af_path] [site] [start] [end] [MB/s]
+
+import sys
+import os
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath( __file__ )),
+    '..', 'py_modules' ))
+
+import load_nmeg as ld
+import mirror_nmeg as mn
+import bz2
+import contextlib
+import gzip
+import io
+import lzma
+import shutil
+import tempfile
+import time
+
+# Data to load and bandwidth of the simulated mount
+af_path = '/home/greg/sftp/eddyflux/Ameriflux_files/FLUXNET2015_a/'
+site = 'US-Seg'
+start = 2007
+end = 2016
+mb_per_s = 5.0
+
+args = sys.argv[ 1: ]
+if len( args ) > 0 : af_path = os.path.join( args[ 0 ], '' )
+if len( args ) > 1 : site = args[ 1 ]
+if len( args ) > 2 : start = int( args[ 2 ])
+if len( args ) > 3 : end = int( args[ 3 ])
+if len( args ) > 4 : mb_per_s = float( args[ 4 ])
+
+
+class ThrottledReader( object ):
+    # A binary file whose reads run no faster than mb_per_s
+    def __init__( self, fin ):
+        self.fin = fin
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.fin.close()
+
+    def fileno( self ):
+        return self.fin.fileno()
+
+    def read( self, size=-1 ):
+        t0 = time.time()
+        block = self.fin.read( size )
+        wait = len( block ) / ( mb_per_s * 1024**2 ) - ( time.time() - t0 )
+        if wait > 0:
+            time.sleep( wait )
+        return block
+
+
+class ThrottledMirror( mn.Mirror ):
+    # A mirror whose copies run no faster than mb_per_s (the copies are
+    # otherwise made as in Mirror, so fresh local files aren't copied again)
+    def _open_remote( self, path ):
+        return ThrottledReader( open( path, 'rb' ))
+
+
+def compressor( fmt ):
+    # Return a function that opens a file for writing in fmt
+    if fmt == 'gz':
+        return lambda f: gzip.open( f, 'wb' )
+    elif fmt == 'bz2':
+        return lambda f: bz2.open( f, 'wb' )
+    elif fmt == 'xz':
+        return lambda f: lzma.open( f, 'wb' )
+    elif fmt == 'zst':
+        import zstandard
+        return lambda f: zstandard.ZstdCompressor().stream_writer(
+                open( f, 'wb' ))
+
+
+formats = [ 'plain', 'gz', 'bz2', 'xz' ]
+try:
+    import zstandard
+    formats.append( 'zst' )
+except ImportError:
+    print( 'zstandard is not installed, skipping .zst files' )
+
+# The year files to copy into the simulated mount
+year_files, empty_yrs = ld._aflx_year_files( site, af_path, start, end,
+        True )
+
+workdir = tempfile.mkdtemp( prefix='nmeg_bench_' )
+results = []
+try:
+    for fmt in formats:
+        mount = os.path.join( workdir, 'mount', fmt, '' )
+        os.makedirs( mount )
+        nbytes = 0
+        for j, fpath in year_files.items():
+            dest = mount + os.path.basename( fpath )
+            if fmt == 'plain':
+                shutil.copy( fpath, dest )
+            else:
+                dest = dest + '.' + fmt
+                with open( fpath, 'rb' ) as fin:
+                    with compressor( fmt )( dest ) as fout:
+                        shutil.copyfileobj( fin, fout )
+            nbytes += os.path.getsize( dest )
+
+        mirror = ThrottledMirror( mount, os.path.join( workdir, 'local',
+            fmt ), blocksize=1024**2 )
+        t0 = time.time()
+        with mirror, contextlib.redirect_stdout( io.StringIO() ):
+            df = ld.get_multiyr_aflx( site, mount, startyear=start,
+                    endyear=end, mirror=mirror )
+        results.append(( fmt, nbytes, time.time() - t0, df.shape ))
+finally:
+    shutil.rmtree( workdir )
+
+print( '{0} {1}-{2} at {3} MB/s'.format( site, start, end, mb_per_s ))
+print( '{0:>6} {1:>10} {2:>9} {3:>8}'.format( 'format', 'MB', 'time (s)',
+    'speedup' ))
+for fmt, nbytes, elapsed, shape in results:
+    print( '{0:>6} {1:>10.1f} {2:>9.2f} {3:>8.2f}'.format( fmt,
+        nbytes / 1024**2, elapsed, results[ 0 ][ 2 ] / elapsed ))
@@ -66,19 +66,12 @@ for i, site in enumerate( siteNames ):
     site_df_MR2005 = ld.get_multiyr_eddyproc( site, datapath + 'eddyproc_out/',
             GL2010=False, startyear=startyear, endyear=endyear )
     # Ensure carbon balance steps (GPP = RE-NEE, add negative values to RE)
-    # Raw GPP (contains negative values)
-    diff = site_df_MR2005.Reco - site_df.FC_F
-    negGPPix = diff<0
-    site_df_MR2005['GPP_ecb'] = diff
-    site_df_MR2005.GPP_ecb.loc[negGPPix] = 0
-    site_df_MR2005['Reco_ecb'] = site_df_MR2005.Reco
-    site_df_MR2005.Reco_ecb[negGPPix] = (
-            site_df_MR2005.Reco_ecb[negGPPix] - diff[negGPPix])
-
+    site_df_MR2005 = pd.concat([ site_df_MR2005, tr.carbon_balance(
+        site_df_MR2005, [( 'GPP_f', 'Reco' )], nee=site_df.FC_F )], axis=1 )
 
     # Create a daily dataframe using just C fluxes
     site_df_MR2005_resamp = tr.resample_30min_aflx( site_df_MR2005, 
-            freq='1D', c_fluxes=[ 'GPP_f', 'Reco', 'GPP_ecb', 'Reco_ecb'], 
+            freq='1D', c_fluxes=[ 'GPP_f', 'Reco', 'GPP_f_ecb', 'Reco_ecb'], 
             le_flux=[], avg_cols=[], int_cols=[], minmax_cols=[],
             sum_cols=[] , tair_col=None)
 
@@ -86,14 +79,9 @@ for i, site in enumerate( siteNames ):
     site_df_GL2010 = ld.get_multiyr_eddyproc( site, datapath + 'eddyproc_out/',
             GL2010=True, startyear=startyear, endyear=endyear )
     # Ensure carbon balance steps (GPP = RE-NEE, add negative values to RE)
-    # Raw GPP (contains negative values)
-    diff = site_df_GL2010.Reco_HBLR - site_df.FC_F
-    negGPPix = diff<0
-    site_df_GL2010['GPP_HBLR_ecb'] = diff
-    site_df_GL2010.GPP_HBLR_ecb.loc[negGPPix] = 0
-    site_df_GL2010['Reco_HBLR_ecb'] = site_df_GL2010.Reco_HBLR
-    site_df_GL2010.Reco_HBLR_ecb[negGPPix] = (
-            site_df_GL2010.Reco_HBLR_ecb[negGPPix] - diff[negGPPix])
+    site_df_GL2010 = pd.concat([ site_df_GL2010, tr.carbon_balance(
+        site_df_GL2010, [( 'GPP_HBLR', 'Reco_HBLR' )], nee=site_df.FC_F )],
+        axis=1 )
 
     # Create a daily dataframe using just C fluxes
     site_df_GL2010_resamp = tr.resample_30min_aflx( site_df_GL2010, 
@@ -107,7 +95,7 @@ for i, site in enumerate( siteNames ):
     site_df_resamp['Reco_MR2005_g_int'] = site_df_MR2005_resamp.Reco_g_int
     site_df_resamp['GPP_MR2005_g_int'] = site_df_MR2005_resamp.GPP_f_g_int
     site_df_resamp['Reco_MR2005_g_int_ecb'] = site_df_MR2005_resamp.Reco_ecb_g_int
-    site_df_resamp['GPP_MR2005_g_int_ecb'] = site_df_MR2005_resamp.GPP_ecb_g_int
+    site_df_resamp['GPP_MR2005_g_int_ecb'] = site_df_MR2005_resamp.GPP_f_ecb_g_int
 
     site_df_resamp['Reco_GL2010_g_int'] = site_df_GL2010_resamp.Reco_HBLR_g_int
     site_df_resamp['GPP_GL2010_g_int'] = site_df_GL2010_resamp.GPP_HBLR_g_int
@@ -34,77 +34,75 @@ hourly = { x :
             startyear=start, endyear=end) 
         for x in sites }
 
+# Derived variables. Hours of C uptake are calculated before resampling
+# (0.5 for each uptake period, to sum), degree days after (values <0 are
+# removed from the second), and GPP/RE on the monthly data
+derived = tr.DerivedVars()
+derived.add( 'hrs_C_uptake', '0.5 * ( FC_F < 0 )', stage='before' )
+derived.add( 'degree_days', '( TA_F_max - TA_F_min ) / 2' )
+derived.add( 'degree_days2', '( TA_F_max + TA_F_min ) / 2', lower=0 )
+monthly_derived = tr.DerivedVars()
+monthly_derived.add( 'GPP_over_RE', 'GPP_g_int / RECO_g_int' )
+
+# SPEI classes for the 3 and 9 month SPEI
+spei_classes = tr.DerivedVars()
+for n in [ 3, 9 ]:
+    spei_col = 'SPEI_monthly_{0}'.format( n )
+    prefix = 'spei{0}mon_'.format( n )
+    spei_classes.add( prefix + 'vwet', spei_col + ' >= 1.5' )
+    spei_classes.add( prefix + 'wet',
+            '( {0} >= 0.5 ) & ( {0} < 1.5 )'.format( spei_col ))
+    spei_classes.add( prefix + 'avg',
+            '( {0} > -0.5 ) & ( {0} < 0.5 )'.format( spei_col ))
+    spei_classes.add( prefix + 'dry',
+            '( {0} <= -0.5 ) & ( {0} > -1.5 )'.format( spei_col ))
+    spei_classes.add( prefix + 'vdry', spei_col + ' <= -1.5' )
+
 # Now calculate the hours of C uptake
-for site in sites:
-    # Add a column with 0.5 for each uptake period (to sum)
-    hourly[site]['hrs_C_uptake'] = 0
-    test = hourly[site].FC_F < 0
-    hourly[site].loc[test, 'hrs_C_uptake'] = 0.5
-    
-# Turn this into a daily dataset
-daily = { x : 
-         tr.resample_30min_aflx( hourly[x], freq='1D', 
+hourly = derived.apply( hourly, stage='before' )
+
+# Aggregate the hourly data once into daily partials, then turn this into
+# a daily dataset (the monthly dataset is made from the same rollup)
+rollup = { x :
+         tr.DailyRollup( hourly[x],
              avg_cols=[ 'TA_F', 'RH_F', 'SW_IN_F', 'RNET_F', 'VPD_F'], 
              minmax_cols=['TA_F', 'VPD_F', 'GPP', 'RECO'],
              sum_cols=[ 'P_F', 'hrs_C_uptake' ] , tair_col='TA_F' )
          for x in hourly.keys() }
+daily = { x : rollup[x].resample( '1D' ) for x in hourly.keys() }
 
-# Now calculate degree days and time of peak fluxes
+# Now calculate degree days (for all sites at once) and time of peak fluxes
 # Do this on a daily basis and add to the dataframes in daily dict
+daily = derived.apply( daily )
 for i, site in enumerate(sites):
-    # Add columns with degree days (and remove <0 values from second)
-    daily[site]['degree_days'] = (daily[site].TA_F_max - daily[site].TA_F_min)/2
-    daily[site]['degree_days2'] = (daily[site].TA_F_max + daily[site].TA_F_min)/2
-    test = daily[site].degree_days2 < 0
-    daily[site].degree_days2[test] = 0
-
     h = hourly[site]
-    # Get the time of day for peak GPP each day
-    gpp_grp = h.GPP.groupby(h.index.date)
-    peakGPP_t = gpp_grp.apply(lambda x: x.index[x==x.max()].time)
-    # Get the time of day for peak NEE each day
-    nee_grp = h.FC_F.groupby(h.index.date)
-    peakNEE_t = nee_grp.apply(lambda x: x.index[x==x.min()].time)
-    # Get the time of day for peak RECO each day
-    reco_grp = h.RECO.groupby(h.index.date)
-    peakRECO_t = reco_grp.apply(lambda x: x.index[x==x.min()].time)
-    def get_frac( arr ):
-        # Sometimes these are empty
-        if len(arr)==0:
-            return np.nan
-        else:
-            return (arr[0].hour*3600 + arr[0].minute*60)/(3600*24)
-    
+    # Get the time of day for peak GPP (max), NEE and RECO (min) each day
+    peaks = tr.daily_peaks( h, max_cols=[ 'GPP' ],
+            min_cols=[ 'FC_F', 'RECO' ])
+
     # Calculate daily ET and PET 
     # (see NMEG_utils/py_modules/transform_nmeg for documentation)
     daily_et_pet = tr.get_daytime_et_pet( h, freq='1D')
     
-    daily[site][ 'peakGPP_dayfrac'] = peakGPP_t.apply( get_frac )
-    daily[site][ 'peakNEE_dayfrac'] = peakNEE_t.apply( get_frac )
-    daily[site][ 'peakRECO_dayfrac'] = peakRECO_t.apply( get_frac )
+    daily[site][ 'peakGPP_dayfrac'] = peaks.GPP_peak_dayfrac
+    daily[site][ 'peakNEE_dayfrac'] = peaks.FC_F_peak_dayfrac
+    daily[site][ 'peakRECO_dayfrac'] = peaks.RECO_peak_dayfrac
     daily[site][ 'ET_mm_dayint'] = daily_et_pet.ET_mm_dayint
     daily[site][ 'PET_mm_dayint'] = daily_et_pet.PET_mm_dayint
 
 
 # Create a monthly file. Columns from daily will need to be resampled and added
-monthly = { x : 
-         tr.resample_30min_aflx( hourly[x], freq='1M', 
-             c_fluxes=[ 'GPP', 'RECO', 'FC_F' ], 
-             le_flux=[ 'LE_F' ], 
-             avg_cols=[ 'TA_F', 'RH_F', 'SW_IN_F', 'RNET_F', 'VPD_F'], 
-             sum_cols=[ 'P_F', 'hrs_C_uptake' ] , tair_col='TA_F' )
-         for x in hourly.keys() }
+monthly = monthly_derived.apply(
+        { x : rollup[x].resample( 'ME' ) for x in hourly.keys() })
 
 # Now add some calculated values and SPEI to the monthly data
 spei_path = '../processed_data/spei/'
 
 for site in sites:
     # First remove some columns from monthly dataframe
-    monthly[site].drop( ['VPD_F_min', 'VPD_F_max', 'TA_F_min', 'TA_F_max'],
-            axis=1, inplace=True)
+    monthly[site].drop( ['VPD_F_min', 'VPD_F_max', 'TA_F_min', 'TA_F_max',
+        'GPP_min', 'GPP_max', 'RECO_min', 'RECO_max'], axis=1, inplace=True)
     # Now add the calculated values (many come from daily data)
-    monthly[site]['GPP_over_RE'] = (
-            monthly[site].GPP_g_int/monthly[site].RECO_g_int)
     monthly[site]['ET_mm_dayint'
             ] = daily[site].ET_mm_dayint.resample('1M').sum()
     monthly[site]['PET_mm_dayint'
@@ -132,22 +130,7 @@ for site in sites:
     # Load monthly SPEI file for the site
     spei = pd.read_csv(spei_path + 'SPEI_monthly_US-' + site + '_nainterp.csv', 
             index_col=0, parse_dates=True, na_values=['NA'])
-    spei['spei3mon_vwet'] = spei.SPEI_monthly_3 >= 1.5
-    spei['spei3mon_wet'] = np.logical_and(spei.SPEI_monthly_3 >= 0.5,
-            spei.SPEI_monthly_3 < 1.5)
-    spei['spei3mon_avg'] = np.logical_and(spei.SPEI_monthly_3 > -0.5,
-            spei.SPEI_monthly_3 < 0.5)
-    spei['spei3mon_dry'] = np.logical_and(spei.SPEI_monthly_3 <= -0.5,
-            spei.SPEI_monthly_3 > -1.5)
-    spei['spei3mon_vdry'] = spei.SPEI_monthly_3 <= -1.5
-    spei['spei9mon_vwet'] = spei.SPEI_monthly_9 >= 1.5
-    spei['spei9mon_wet'] = np.logical_and(spei.SPEI_monthly_9 >= 0.5,
-            spei.SPEI_monthly_9 < 1.5)
-    spei['spei9mon_avg'] = np.logical_and(spei.SPEI_monthly_9 > -0.5,
-            spei.SPEI_monthly_9 < 0.5)
-    spei['spei9mon_dry'] = np.logical_and(spei.SPEI_monthly_9 <= -0.5,
-            spei.SPEI_monthly_9 > -1.5)
-    spei['spei9mon_vdry'] = spei.SPEI_monthly_9 <= -1.5
+    spei = spei_classes.apply( spei )
 
 
     # Join the two files on the date index
@@ -0,0 +1,195 @@
+"""
+Memory-mapped site x time x variable archive of NMEG 30 minute data
+
+ archive_nmeg.py
+ Greg Maurer
+"""
+
+import numpy as np
+import pandas as pd
+import json
+import os
+import load_nmeg as ld
+
+# Name of the index file in an archive directory
+index_file = 'archive.json'
+
+
+def build_archive( archive_path, afpath, sites, startyear, endyear,
+        variables=None, site_prefix='US-', gapfilled=True, dtype='float64',
+        **loader_kwargs ) :
+    """
+    Build an on-disk archive of multi-year ameriflux data for a list of
+    sites (e.g. plot_nmeg.allsites). Each variable is stored as one dense
+    (site, 30 minute slot) array in a .npy file that can be memory-mapped,
+    and a small json index maps site codes, variable names and the time
+    origin to array offsets. Sites are loaded one at a time with
+    load_nmeg.get_multiyr_aflx.
+
+    Args:
+        archive_path (str)  : directory to write the archive to
+        afpath (str)        : path to directory of ameriflux files
+        sites (list)        : list of site codes (e.g. ['Seg', 'Ses'])
+        startyear (int)     : first year of data to include
+        endyear (int)       : last year of data to include
+        variables (list)    : variables to archive (default all)
+        site_prefix (str)   : prefix for AF file site names
+        gapfilled (bool)    : true=gapfilled, false=with_gaps files
+        dtype (str)         : dtype of the stored arrays. float64 matches
+                              get_multiyr_aflx; float32 halves the archive
+                              size but keeps only ~7 significant digits
+                              (frames are still returned as float64)
+        loader_kwargs       : other arguments for get_multiyr_aflx (e.g.
+                              old_dparse or cache)
+
+    Return:
+        archive     : NMEGArchive object opened on archive_path
+    """
+    if not os.path.isdir( archive_path ):
+        os.makedirs( archive_path )
+
+    # 30 minute slots from startyear-01-01 00:30 to endyear+1-01-01 00:00
+    full_idx = pd.date_range( str( startyear ) + '-01-01 00:30:00',
+            str( endyear + 1 ) + '-01-01 00:00:00', freq = '30min')
+    index = { 'sites' : list( sites ), 'variables' : [], 'files' : {},
+            'origin' : str( full_idx[ 0 ]), 'freq' : '30min',
+            'nslots' : len( full_idx ), 'dtype' : dtype }
+    blocks = {}
+
+    for i, site in enumerate( sites ):
+        site_df = ld.get_multiyr_aflx( site_prefix + site, afpath,
+                startyear=startyear, endyear=endyear, gapfilled=gapfilled,
+                columns=variables, **loader_kwargs )
+        pos = full_idx.get_indexer( site_df.index )
+        inrange = pos >= 0
+        for cname in site_df.columns:
+            if cname not in blocks:
+                # First time this variable is seen - add a block for it
+                fname = 'v{0}.npy'.format( len( index[ 'variables' ]))
+                blocks[ cname ] = np.lib.format.open_memmap(
+                        os.path.join( archive_path, fname ), mode='w+',
+                        dtype=dtype, shape=( len( sites ), len( full_idx )))
+                blocks[ cname ][ : ] = np.nan
+                index[ 'variables' ].append( cname )
+                index[ 'files' ][ cname ] = fname
+            vals = site_df[ cname ].to_numpy( dtype=np.float64,
+                    na_value=np.nan )
+            blocks[ cname ][ i, pos[ inrange ]] = vals[ inrange ]
+
+    for block in blocks.values():
+        block.flush()
+    with open( os.path.join( archive_path, index_file ), 'w' ) as fout:
+        json.dump( index, fout, indent=1 )
+
+    return NMEGArchive( archive_path )
+
+
+class NMEGArchive(object):
+    """
+    An archive written by build_archive. Opening an archive only reads the
+    json index; each variable block is memory-mapped the first time it is
+    used, and slicing a block reads only the requested part from disk.
+
+    Args:
+        archive_path (str)  : directory of the archive
+    """
+
+    def __init__( self, archive_path ):
+        self.archive_path = archive_path
+        with open( os.path.join( archive_path, index_file )) as fin:
+            self._index = json.load( fin )
+        self.sites = self._index[ 'sites' ]
+        self.variables = self._index[ 'variables' ]
+        self.origin = pd.Timestamp( self._index[ 'origin' ])
+        self.freq = pd.Timedelta( self._index[ 'freq' ])
+        self.nslots = self._index[ 'nslots' ]
+        self._blocks = {}
+
+    @property
+    def index( self ):
+        """ DatetimeIndex of all 30 minute slots in the archive """
+        return pd.date_range( self.origin, periods=self.nslots,
+                freq=self.freq )
+
+    def block( self, varname ):
+        """
+        Return the memory-mapped (site, slot) array for a variable
+        """
+        if varname not in self._blocks:
+            fname = self._index[ 'files' ][ varname ]
+            self._blocks[ varname ] = np.load( os.path.join(
+                self.archive_path, fname ), mmap_mode='r' )
+        return self._blocks[ varname ]
+
+    def slot( self, tstamp ):
+        """
+        Return the slot offset of a timestamp (rounded up to a whole slot)
+        """
+        offset = ( pd.Timestamp( tstamp ) - self.origin ) / self.freq
+        return int( np.ceil( offset ))
+
+    def _slots( self, start, end ):
+        # Slice of slots from start to end (inclusive), clipped to archive
+        s0 = 0 if start is None else max( self.slot( start ), 0 )
+        s1 = self.nslots if end is None else min(
+                int( np.floor(( pd.Timestamp( end ) - self.origin ) /
+                    self.freq )) + 1, self.nslots )
+        return slice( s0, max( s0, s1 ))
+
+    def get( self, varname, sites=None, start=None, end=None ):
+        """
+        Return a (site, slot) array of one variable. Nothing outside the
+        requested sites and time range is read from disk.
+
+        Args:
+            varname (str)   : variable name
+            sites (list)    : site codes (default all, in archive order)
+            start, end      : optional first and last timestamps
+
+        Return:
+            arr         : numpy array (a memmap view if the sites are
+                          consecutive in the archive, otherwise a copy)
+        """
+        slots = self._slots( start, end )
+        blk = self.block( varname )
+        if sites is None:
+            return blk[ :, slots ]
+        rows = [ self.sites.index( s ) for s in sites ]
+        if rows == list( range( rows[ 0 ], rows[ 0 ] + len( rows ))):
+            return blk[ rows[ 0 ]:rows[ 0 ] + len( rows ), slots ]
+        return blk[ rows, slots ]
+
+    def var_frame( self, varname, sites=None, start=None, end=None ):
+        """
+        Return one variable as a float64 DataFrame with a column for each
+        site (like transform_nmeg.get_var_allsites). For a float64 archive
+        and sites that are consecutive in the archive (e.g. the default,
+        all sites) the frame is a read-only view of the memory-mapped
+        block. Otherwise it is a copy (a float32 archive is cast back to
+        float64).
+        """
+        if sites is None:
+            sites = self.sites
+        slots = self._slots( start, end )
+        vals = self.get( varname, sites, start, end ).T
+        if vals.dtype != np.float64:
+            vals = vals.astype( np.float64 )
+        return pd.DataFrame( vals, index=self.index[ slots ],
+                columns=list( sites ), copy=False )
+
+    def site_frame( self, site, variables=None, start=None, end=None ):
+        """
+        Return a DataFrame for one site like the ones from
+        load_nmeg.get_multiyr_aflx (30 minute index, one float64 column per
+        variable). Only the site's row of each variable block is read, and
+        the frame is a copy of it, not a view of the archive (values from
+        a float32 archive are cast back to float64).
+        """
+        if variables is None:
+            variables = self.variables
+        i = self.sites.index( site )
+        slots = self._slots( start, end )
+        cols = { v : np.array( self.block( v )[ i, slots ], dtype=np.float64 )
+                for v in variables }
+        return pd.DataFrame( cols, index=self.index[ slots ],
+                columns=list( variables ))
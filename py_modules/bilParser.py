@@ -2,6 +2,7 @@ import gdal
 import gdalconst
 import pandas as pd
 import pdb
+import os
 
 class BilFile(object):
 # This is the class used to open a .bil file and make georeferenced data
@@ -35,14 +36,24 @@ class BilFile(object):
         x = int((lon - self.originX)/self.pixelWidth)
         return self.data[y, x]
 
+# Return the path to read a PRISM file from - a local copy if a
+# mirror_nmeg.Mirror is given (for data_path on a slow network mount)
+def _prism_path(data_path, fname, mirror=None):
+    if mirror is None:
+        return data_path + fname
+    return mirror.local_path(data_path + fname)
+
 # Function for extracting daily PRISM data
-def getDailyPrism(year, metdata, data_path, coords_file):
+def getDailyPrism(year, metdata, data_path, coords_file, mirror=None):
     # Read in site coordinates, get date range and create a DataFrame
     #to fill
     pnts = pd.read_csv(coords_file)
     drange =  pd.date_range('1-1-{0}'.format(year),
             '12-31-{0}'.format(year), freq='D')
     df = pd.DataFrame(index=drange, columns=pnts.sitecode)
+    zip_file = _prism_path(data_path,
+            r'PRISM_{0}_stable_4kmD2_{1}0101_{1}1231_bil.zip'.format(
+                metdata, year), mirror)
     for i in range(len(drange)):
         # Create a tuple to fill the file dates in,
         # pad month & day with zeros
@@ -53,9 +64,7 @@ def getDailyPrism(year, metdata, data_path, coords_file):
         # See https://trac.osgeo.org/gdal/wiki/UserDocs/ReadInZip
         # If for some reason this vsizip interface won't work, extract the
         # archive and remove the 'vsizip' part of pathname
-        bil_file = (r'/vsizip/' + data_path +
-        r'PRISM_{0}_stable_4kmD2_{1}0101_{1}1231_bil.zip/'.format(
-            metdata, year) +
+        bil_file = (r'/vsizip/' + zip_file + '/' +
         r'PRISM_{0}_stable_4kmD2_{1}{2}{3}_bil.bil'.format(metdata, *ymd_tuple))
         bil_ds = BilFile(bil_file)
         for j in range(len(pnts.index)):
@@ -64,7 +73,8 @@ def getDailyPrism(year, metdata, data_path, coords_file):
     return df
 
 # Function for extracting daily PRISM data from provisional files
-def getDailyPrismProvis(year, month, metdata, data_path, bil_name, coords_file):
+def getDailyPrismProvis(year, month, metdata, data_path, bil_name, coords_file,
+        mirror=None):
     # Read in site coordinates, get date range and create a DataFrame
     #to fill
     pnts = pd.read_csv(coords_file)
@@ -72,6 +82,7 @@ def getDailyPrismProvis(year, month, metdata, data_path, bil_name, coords_file):
             '{0}-12-31'.format(year), freq='D')
     drange = drange[drange.month==month]
     df = pd.DataFrame(index=drange, columns=pnts.sitecode)
+    zip_file = _prism_path(data_path, bil_name, mirror)
     for i in range(len(drange)):
         # Create a tuple to fill the file dates in,
         # pad month & day with zeros
@@ -82,7 +93,7 @@ def getDailyPrismProvis(year, month, metdata, data_path, bil_name, coords_file):
         # See https://trac.osgeo.org/gdal/wiki/UserDocs/ReadInZip
         # If for some reason this vsizip interface won't work, extract the
         # archive and remove the 'vsizip' part of pathname
-        bil_file = (r'/vsizip/' + data_path + bil_name + '/' +
+        bil_file = (r'/vsizip/' + zip_file + '/' +
         r'PRISM_{0}_provisional_4kmD2_{1}{2}{3}_bil.bil'.format(metdata, 
             *ymd_tuple))
         bil_ds = BilFile(bil_file)
@@ -95,12 +106,20 @@ def getDailyPrismProvis(year, month, metdata, data_path, bil_name, coords_file):
 # Function for extracting monthly PRISM data
 # Note that this uses 1981-2015 files and will need to be altered if different
 # files are used
-def getMonthlyPrism( metdata, data_path, coords_file ):
+def getMonthlyPrism( metdata, data_path, coords_file, mirror=None ):
     # Read in site coordinates, get date range and create a DataFrame
     #to fill
     pnts = pd.read_csv(coords_file)
     drange =  pd.date_range('1-1-1981', '9-30-2015', freq='M')
     df = pd.DataFrame(index=drange, columns=pnts.sitecode)
+    if metdata=='ppt':
+        zip_file = _prism_path(data_path,
+                r'PRISM_{0}_stable_4kmM3_198101_201509_bil.zip'.format(
+                    metdata), mirror)
+    elif metdata=='tmean':
+        zip_file = _prism_path(data_path,
+                r'PRISM_{0}_stable_4kmM2_198101_201509_bil.zip'.format(
+                    metdata), mirror)
     for i in range(len(drange)):
         # Create a tuple to fill the file dates in,
         # pad month & day with zeros
@@ -111,15 +130,11 @@ def getMonthlyPrism( metdata, data_path, coords_file ):
         # If for some reason this vsizip interface won't work, extract the
         # archive and remove the 'vsizip' part of pathname
         if metdata=='ppt':
-            bil_file = (r'/vsizip/' + data_path +
-                    r'PRISM_{0}_stable_4kmM3_198101_201509_bil.zip/'.format(
-                        metdata) +
+            bil_file = (r'/vsizip/' + zip_file + '/' +
                     r'PRISM_{0}_stable_4kmM3_{1}{2}_bil.bil'.format(
                         metdata, *ym_tuple))
         elif metdata=='tmean':
-            bil_file = (r'/vsizip/' + data_path +
-                    r'PRISM_{0}_stable_4kmM2_198101_201509_bil.zip/'.format(
-                        metdata) +
+            bil_file = (r'/vsizip/' + zip_file + '/' +
                     r'PRISM_{0}_stable_4kmM2_{1}{2}_bil.bil'.format(
                         metdata, *ym_tuple))
 
@@ -130,7 +145,8 @@ def getMonthlyPrism( metdata, data_path, coords_file ):
     return df
 
 # Function for extracting monthly PRISM data from provisional files
-def getMonthlyPrismProvis(year, metdata, data_path, bil_name, coords_file):
+def getMonthlyPrismProvis(year, metdata, data_path, bil_name, coords_file,
+        mirror=None):
     # Read in site coordinates, get date range and create a DataFrame
     #to fill
     pnts = pd.read_csv(coords_file)
@@ -138,6 +154,7 @@ def getMonthlyPrismProvis(year, metdata, data_path, bil_name, coords_file):
             '{0}-12-31'.format(year), freq='M')
     #drange = drange[drange.month==month]
     df = pd.DataFrame(index=drange, columns=pnts.sitecode)
+    zip_file = _prism_path(data_path, bil_name, mirror)
     for i in range(len(drange)):
         # Create a tuple to fill the file dates in,
         # pad month & day with zeros
@@ -147,7 +164,7 @@ def getMonthlyPrismProvis(year, metdata, data_path, bil_name, coords_file):
         # See https://trac.osgeo.org/gdal/wiki/UserDocs/ReadInZip
         # If for some reason this vsizip interface won't work, extract the
         # archive and remove the 'vsizip' part of pathname
-        bil_file = (r'/vsizip/' + data_path + bil_name + '/' +
+        bil_file = (r'/vsizip/' + zip_file + '/' +
         r'PRISM_{0}_provisional_4kmM2_{1}{2}_bil.bil'.format(metdata, 
             *ym_tuple))
         #pdb.set_trace()
@@ -159,7 +176,7 @@ def getMonthlyPrismProvis(year, metdata, data_path, bil_name, coords_file):
 
 
 # Function for extracting 30 year normal PRISM precip data
-def get30yrPrismPrecip(data_path, coords_file):
+def get30yrPrismPrecip(data_path, coords_file, mirror=None):
     # Read in site coordinates, get date range and create a DataFrame
     #to fill
     pnts = pd.read_csv(coords_file)
@@ -167,6 +184,13 @@ def get30yrPrismPrecip(data_path, coords_file):
 
     bil_file = (data_path  +
             r'PRISM_ppt_30yr_normal_800mM2_annual_bil.bil')
+    if mirror is not None:
+        # Copy the header and other sidecar files along with the .bil
+        base = bil_file[:-len('.bil')]
+        for ext in ['.hdr', '.prj', '.stx', '.bil.aux.xml']:
+            if os.path.exists(base + ext):
+                mirror.local_path(base + ext)
+        bil_file = mirror.local_path(bil_file)
     bil_ds = BilFile(bil_file)
     for j in range(len(pnts.index)):
         precip = bil_ds.extract_coord_val(pnts.lat[j], pnts.lon[j])
@@ -0,0 +1,232 @@
+"""
+On-disk cache for parsed NMEG data files
+
+ cache_nmeg.py
+ Greg Maurer
+"""
+
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import time
+
+
+class FrameCache(object):
+    """
+    A directory of parsed (and reindexed) DataFrames stored column by column
+    in uncompressed numpy .npz files. Entries are keyed on the source file
+    path, size, mtime, and the arguments of the loader, so a changed source
+    file is never served from the cache. The total size is capped and the
+    least recently used entries are evicted first.
+
+    Args:
+        cache_dir (str)  : directory to hold cache entries (created if needed)
+        max_bytes (int)  : size cap for all entries (default 4 GB)
+    """
+
+    def __init__(self, cache_dir, max_bytes=4*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def make_key(self, fname, loader, **kwargs):
+        """
+        Make a cache key from a source file and the loader used to parse it
+
+        Args:
+            fname (str)  : path and filename of the source file
+            loader (str) : name of the loader function
+            kwargs       : loader arguments that change the parsed result
+
+        Return:
+            key (str)    : hex digest identifying the entry
+        """
+        st = os.stat(fname)
+        keydata = json.dumps([os.path.abspath(fname), st.st_size,
+            st.st_mtime_ns, loader, sorted(kwargs.items())], default=str)
+        return hashlib.sha1(keydata.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        Return the cached DataFrame for key, or None if there is no entry
+        """
+        path = self._entry_path(key)
+        try:
+            df = load_frame(path)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # The entry file mtime records the last use (for LRU eviction)
+        os.utime(path, None)
+        return df
+
+    def put(self, key, df, source=''):
+        """
+        Store a DataFrame under key and evict old entries if over the cap
+        """
+        save_frame(self._entry_path(key), df, source=source)
+        self.evict()
+
+    def info(self):
+        """
+        Return a DataFrame describing each cache entry (source file, size
+        and last use time), most recently used first.
+        """
+        rows = []
+        for key, path, size, mtime in self._entries():
+            try:
+                meta = load_frame_meta(path)
+            except (IOError, OSError, ValueError, KeyError):
+                meta = {}
+            rows.append({'key' : key, 'source' : meta.get('source', ''),
+                'nrows' : meta.get('nrows'), 'ncols' : meta.get('ncols'),
+                'bytes' : size, 'last_used' : pd.Timestamp(mtime, unit='s')})
+        info = pd.DataFrame(rows, columns=['key', 'source', 'nrows', 'ncols',
+            'bytes', 'last_used'])
+        return info.sort_values('last_used', ascending=False).reset_index(
+                drop=True)
+
+    def size(self):
+        """
+        Return the total size (bytes) of all cache entries
+        """
+        return sum(e[2] for e in self._entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache is under
+        max_bytes (defaults to the cache size cap). Returns number removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[3])
+        total = sum(e[2] for e in entries)
+        nremoved = 0
+        for key, path, size, mtime in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            nremoved += 1
+        return nremoved
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        return self.evict(max_bytes=0)
+
+    def _entries(self):
+        # (key, path, size, mtime) for each finished entry in cache_dir
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.npz'):
+                continue
+            path = os.path.join(self.cache_dir, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((f[:-4], path, st.st_size, st.st_mtime))
+        return entries
+
+
+def save_frame(path, df, source='', **extra_meta):
+    """
+    Save a DataFrame column by column to an uncompressed .npz file. The
+    file is written to a temporary name and moved in place so that readers
+    (or other processes) never see a partial file.
+
+    Args:
+        path (str)      : file to write
+        df (obj)        : pandas DataFrame
+        source (str)    : source file name to record with the frame
+        extra_meta      : other json-serializable values to record (these
+                          are returned by load_frame_meta)
+    """
+    tmp = path + '.{0}.tmp'.format(os.getpid())
+    with open(tmp, 'wb') as fout:
+        np.savez(fout, **_frame_to_arrays(df, source, extra_meta))
+    os.replace(tmp, path)
+
+
+def load_frame(path):
+    """
+    Load a DataFrame saved with save_frame
+    """
+    with np.load(path, allow_pickle=True) as npz:
+        return _frame_from_npz(npz)
+
+
+def load_frame_meta(path):
+    """
+    Load only the metadata record of a file saved with save_frame
+    """
+    with np.load(path, allow_pickle=True) as npz:
+        return json.loads(str(npz['meta']))
+
+
+def _frame_to_arrays(df, source='', extra_meta={}):
+    # Split a DataFrame into one array per column plus a metadata record.
+    # Nullable integer and categorical columns (see load_nmeg.compact_frame)
+    # are stored as values + mask and codes + categories.
+    arrays = {}
+    kinds = []
+    for i, cname in enumerate(df.columns):
+        col = df.iloc[:, i]
+        name = 'c{0}'.format(i)
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            arrays[name] = col.cat.codes.values
+            arrays[name + '_cats'] = np.asarray(col.cat.categories.values)
+            kinds.append('category')
+        elif isinstance(col.dtype, pd.api.extensions.ExtensionDtype):
+            arrays[name] = col.to_numpy(dtype=col.dtype.numpy_dtype,
+                    na_value=0)
+            arrays[name + '_mask'] = col.isna().values
+            kinds.append(str(col.dtype))
+        else:
+            arrays[name] = np.asarray(col.values)
+            kinds.append('numpy')
+    if isinstance(df.index, pd.DatetimeIndex):
+        arrays['index'] = df.index.values.astype('datetime64[ns]')
+    else:
+        arrays['index'] = np.asarray(df.index.values)
+    meta = {'source' : source, 'columns' : [str(c) for c in df.columns],
+            'kinds' : kinds, 'index_name' : df.index.name,
+            'nrows' : len(df.index),
+            'ncols' : len(df.columns), 'created' : time.time()}
+    meta.update(extra_meta)
+    arrays['meta'] = np.array(json.dumps(meta))
+    return arrays
+
+
+def _frame_from_npz(npz):
+    # Rebuild a DataFrame written by _frame_to_arrays
+    meta = json.loads(str(npz['meta']))
+    idx = npz['index']
+    if idx.dtype.kind == 'M' and len(idx) > 2:
+        idx = pd.DatetimeIndex(idx, freq='infer', name=meta['index_name'])
+    else:
+        idx = pd.Index(idx, name=meta['index_name'])
+    cols = {}
+    for i, kind in enumerate(meta['kinds']):
+        name = 'c{0}'.format(i)
+        if kind == 'category':
+            cols[i] = pd.Categorical.from_codes(npz[name],
+                    npz[name + '_cats'])
+        elif kind == 'numpy':
+            cols[i] = npz[name]
+        else:
+            cols[i] = pd.array(npz[name], dtype=kind)
+            cols[i][npz[name + '_mask']] = pd.NA
+    df = pd.DataFrame(cols, index=idx)
+    df.columns = meta['columns']
+    return df
@@ -0,0 +1,212 @@
+"""
+Catalog of NMEG data files (AmeriFlux, fluxall, soilmet, eddyproc, PRISM)
+
+ catalog_nmeg.py
+ Greg Maurer
+"""
+
+import pandas as pd
+import json
+import os
+import re
+
+# Compressed copies of the text files are matched too
+compressed_exts = ( '.gz', '.bz2', '.xz', '.zst' )
+_zext = r'(?:\.(?:gz|bz2|xz|zst))?$'
+
+# Filename patterns for each product. Site names can contain '_' (e.g.
+# 'PJ_girdle'), so the site is everything before the _YYYY_<product> suffix.
+patterns = {
+    'aflx' : re.compile(
+        r'(?P<site>.+?)_(?P<year>\d{4})_(?P<variant>gapfilled|with_gaps)'
+        r'\.txt' + _zext),
+    'fluxall' : re.compile(
+        r'(?P<site>.+?)_(?P<year>\d{4})_fluxall\.txt' + _zext),
+    'soilmet' : re.compile(
+        r'(?P<site>.+?)_(?P<year>\d{4})_soilmet_(?P<variant>qc[a-z_]*)'
+        r'\.txt' + _zext),
+    'eddyproc' : re.compile(
+        r'DataSetafterFluxpart(?P<variant>GL2010)?_(?P<year>\d{4})\.txt'
+        + _zext),
+    'prism' : re.compile(
+        r'PRISM_(?P<variant>[a-z0-9]+_(?:stable|provisional)_[A-Za-z0-9]+)_'
+        r'(?P<year>\d{4})\d*(?:_\d+)?_bil\.(?:zip|bil)$'),
+    }
+
+
+def parse_filename( fname ) :
+    """
+    Parse the product, site, year and variant out of an NMEG data filename.
+
+    Args:
+        fname (str) : file name (no directory)
+
+    Return:
+        tuple of (product, site, year, variant), or None if the name is not
+        a known data file. site is None for eddyproc and PRISM files, and
+        variant is '' for products without variants.
+    """
+    for product, pat in patterns.items():
+        m = pat.match( fname )
+        if m:
+            gd = m.groupdict()
+            return ( product, gd.get( 'site' ), int( gd[ 'year' ]),
+                    gd.get( 'variant' ) or '' )
+    return None
+
+
+class DataCatalog(object):
+    """
+    An index of NMEG data files in one or more directory trees. Each
+    directory is listed once and every recognized filename is parsed into
+    (product, site, year, variant) and stored with its size and mtime.
+    Lookups are dict lookups. refresh() lists again only the directories
+    whose mtime has changed (files replaced in place keep their old size
+    and mtime until their directory is rescanned).
+
+    Args:
+        roots (list)        : directories to scan, along with their
+                              immediate subdirectories (e.g. the fluxall
+                              and eddyproc site directories)
+        index_file (str)    : optional json file to load a saved catalog
+                              from (the catalog is refreshed after loading)
+    """
+
+    def __init__( self, roots=(), index_file=None ) :
+        self._dirs = {}
+        self._entries = {}
+        self._roots = []
+        if index_file is not None and os.path.exists( index_file ):
+            self.load( index_file )
+            self.refresh()
+        for root in roots:
+            self.add_root( root )
+
+    def add_root( self, root ) :
+        """ Scan a directory and its immediate subdirectories """
+        root = _dirkey( root )
+        if root not in self._roots:
+            self._roots.append( root )
+        self.add_dir( root )
+        for sub in os.listdir( root ):
+            if os.path.isdir( os.path.join( root, sub )):
+                self.add_dir( os.path.join( root, sub ))
+
+    def add_dir( self, dirpath ) :
+        """ Scan one directory (replacing any entries it had) """
+        dirpath = _dirkey( dirpath )
+        for key in [ k for k in self._entries if k[ 0 ] == dirpath ]:
+            del self._entries[ key ]
+        st = os.stat( dirpath )
+        with os.scandir( dirpath ) as it:
+            for f in it:
+                parsed = parse_filename( f.name )
+                if parsed is None or not f.is_file():
+                    continue
+                key = ( dirpath, ) + parsed
+                # Prefer a plain file over compressed copies of it
+                if ( key in self._entries and
+                        f.name.endswith( compressed_exts )):
+                    continue
+                fst = f.stat()
+                self._entries[ key ] = ( f.path, fst.st_size, fst.st_mtime )
+        self._dirs[ dirpath ] = st.st_mtime_ns
+
+    def refresh( self ) :
+        """
+        Rescan directories that changed since they were last scanned (and
+        add new subdirectories of roots). Returns the list of rescanned
+        directories.
+        """
+        rescanned = []
+        for dirpath, mtime in list( self._dirs.items() ):
+            try:
+                st = os.stat( dirpath )
+            except OSError:
+                # Directory is gone - drop it and its entries
+                del self._dirs[ dirpath ]
+                for key in [ k for k in self._entries if k[ 0 ] == dirpath ]:
+                    del self._entries[ key ]
+                rescanned.append( dirpath )
+                continue
+            if st.st_mtime_ns != mtime:
+                self.add_dir( dirpath )
+                rescanned.append( dirpath )
+        for root in self._roots:
+            if root not in rescanned or not os.path.isdir( root ):
+                continue
+            for sub in os.listdir( root ):
+                subpath = _dirkey( os.path.join( root, sub ))
+                if os.path.isdir( subpath ) and subpath not in self._dirs:
+                    self.add_dir( subpath )
+                    rescanned.append( subpath )
+        return rescanned
+
+    def find( self, dirpath, product, site, year, variant='' ) :
+        """
+        Return the path of a data file in dirpath, or None if there is no
+        such file. Directories not yet in the catalog are scanned first.
+
+        Args:
+            dirpath (str)   : directory holding the file
+            product (str)   : 'aflx', 'fluxall', 'soilmet', 'eddyproc' or
+                              'prism'
+            site (str)      : site name as used in the filename (None for
+                              eddyproc and PRISM files)
+            year (int)      : year of the file
+            variant (str)   : e.g. 'gapfilled', 'qc_rbd' or 'GL2010'
+        """
+        entry = self.entry( dirpath, product, site, year, variant )
+        if entry is None:
+            return None
+        return entry[ 'path' ]
+
+    def entry( self, dirpath, product, site, year, variant='' ) :
+        """
+        Return a dict with the path, size and mtime of a data file, or None
+        """
+        dirpath = _dirkey( dirpath )
+        if dirpath not in self._dirs:
+            if not os.path.isdir( dirpath ):
+                return None
+            self.add_dir( dirpath )
+        found = self._entries.get( ( dirpath, product, site, year, variant ))
+        if found is None:
+            return None
+        return dict( zip( ( 'path', 'size', 'mtime' ), found ))
+
+    def entries( self, product=None, site=None ) :
+        """
+        Return a DataFrame listing catalog entries (optionally only those
+        for one product and/or site)
+        """
+        rows = [ k + v for k, v in self._entries.items()
+                if ( product is None or k[ 1 ] == product ) and
+                ( site is None or k[ 2 ] == site ) ]
+        return pd.DataFrame( rows, columns=[ 'dir', 'product', 'site',
+            'year', 'variant', 'path', 'size', 'mtime' ])
+
+    def save( self, index_file ) :
+        """ Save the catalog to a json file """
+        state = { 'roots' : self._roots,
+                'dirs' : self._dirs,
+                'entries' : [ list( k ) + list( v )
+                    for k, v in self._entries.items() ]}
+        tmp = index_file + '.tmp'
+        with open( tmp, 'w' ) as fout:
+            json.dump( state, fout )
+        os.replace( tmp, index_file )
+
+    def load( self, index_file ) :
+        """ Load a catalog saved with save() """
+        with open( index_file ) as fin:
+            state = json.load( fin )
+        self._roots = state[ 'roots' ]
+        self._dirs = state[ 'dirs' ]
+        self._entries = { tuple( e[ 0:5 ] ) : tuple( e[ 5: ])
+                for e in state[ 'entries' ]}
+
+
+def _dirkey( dirpath ) :
+    # Directories are stored as normalized absolute paths
+    return os.path.normpath( os.path.abspath( dirpath ))
@@ -9,12 +9,324 @@ import numpy as np
 import datetime as dt
 import pandas as pd
 import os
+import io
+import json
+import hashlib
+import contextlib
+import gzip
+import bz2
+import lzma
+import concurrent.futures as cf
+import collections
+import itertools
+import re
 import pdb as pdb
+import cache_nmeg
+import mirror_nmeg
 
 now = dt.datetime.now()
 
 
-def load_aflx_file( fname, year, old_date_parse=False ) :
+def _cached_load( loader, fname, cache=None, **kwargs ) :
+    """
+    Call loader( fname, **kwargs ), going through cache (a
+    cache_nmeg.FrameCache) if one is given. On a cache hit the file is not
+    parsed at all.
+    """
+    if cache is None:
+        return loader( fname, **kwargs )
+    key = cache.make_key( fname, loader.__name__, **kwargs )
+    parsed_df = cache.get( key )
+    if parsed_df is None:
+        parsed_df = loader( fname, **kwargs )
+        cache.put( key, parsed_df, source=fname )
+    else:
+        print('Loaded cached ' + fname)
+    return parsed_df
+
+
+def assemble_multiyr( year_frames, newidx ) :
+    """
+    Assemble a list of 1-year DataFrames into one DataFrame on a multi-year
+    index. The output is preallocated on newidx with the union of all
+    columns, each year is written into its slot, and the index is checked
+    for overlapping values once at the end (this replaces repeated
+    DataFrame.append calls, which copy all previous years each time).
+
+    Args:
+        year_frames : list of pandas DataFrames with datetime indexes
+        newidx      : DatetimeIndex of the assembled frame (usually the full
+                      30 minute grid from startyear to endyear). Rows
+                      outside newidx are dropped.
+
+    Return:
+        site_df     : pandas DataFrame indexed by newidx
+    """
+    if len( year_frames ) == 0:
+        return pd.DataFrame( index=newidx )
+
+    # Union of columns (in order of appearance) and their output dtypes.
+    # Compact dtypes (float32, UInt8 flags, categoricals) are kept if all
+    # years agree on them.
+    col_dtypes = {}
+    for df in year_frames:
+        for cname, dtype in df.dtypes.items():
+            col_dtypes.setdefault( cname, [] ).append( dtype )
+    out_cols = {}
+    out_masks = {}
+    categoricals = []
+    for cname, dtypes in col_dtypes.items():
+        if all( d == 'UInt8' for d in dtypes ):
+            out_cols[ cname ] = np.zeros( len( newidx ), dtype=np.uint8 )
+            out_masks[ cname ] = np.ones( len( newidx ), dtype=bool )
+            continue
+        if all( isinstance( d, pd.CategoricalDtype ) for d in dtypes ):
+            categoricals.append( cname )
+        if all( d == np.float32 for d in dtypes ):
+            out_dtype = np.float32
+        elif all( d.kind in 'fiu' for d in dtypes ):
+            out_dtype = np.float64
+        else:
+            out_dtype = object
+        out_cols[ cname ] = np.full( len( newidx ), np.nan, dtype=out_dtype )
+
+    # Write each year into its slot of the preallocated arrays
+    for df in year_frames:
+        pos = newidx.get_indexer( df.index )
+        inrange = pos >= 0
+        pos = pos[ inrange ]
+        for cname in df.columns:
+            out = out_cols[ cname ]
+            vals = df[ cname ][ inrange ]
+            if cname in out_masks:
+                out[ pos ] = vals.to_numpy( dtype=np.uint8, na_value=0 )
+                out_masks[ cname ][ pos ] = vals.isna().values
+            elif out.dtype == object:
+                out[ pos ] = vals.to_numpy( dtype=object )
+            else:
+                out[ pos ] = vals.to_numpy( dtype=out.dtype,
+                        na_value=np.nan )
+
+    for cname in out_masks:
+        out_cols[ cname ] = pd.arrays.IntegerArray( out_cols[ cname ],
+                out_masks[ cname ])
+    for cname in categoricals:
+        out_cols[ cname ] = pd.Categorical( out_cols[ cname ])
+
+    # Check (once) that no timestamp occurs twice, in one or across years
+    all_idx = np.concatenate([ df.index.values for df in year_frames ])
+    if not pd.Index( all_idx ).is_unique:
+        raise ValueError( 'Indexes have overlapping values' )
+
+    return pd.DataFrame( out_cols, index=newidx )
+
+
+def compact_frame( df, verbose=True ) :
+    """
+    Convert a DataFrame to compact dtypes: measurements to float32, flag
+    columns holding small integers to nullable UInt8, and repeated text to
+    categoricals. Prints the memory saved if verbose is True.
+
+    Args:
+        df (obj)        : pandas DataFrame (usually from one of the loaders)
+        verbose (bool)  : print memory use before and after
+
+    Return:
+        compact_df      : pandas DataFrame with compact column dtypes
+    """
+    before = df.memory_usage( deep=True ).sum()
+    compact_cols = {}
+    for i, cname in enumerate( df.columns ):
+        col = df.iloc[ :, i ]
+        is_flag = 'FLAG' in str( cname ).upper()
+        if isinstance( col.dtype, np.dtype ) and col.dtype.kind in 'fiu':
+            vals = col.values[ col.notna().values ]
+            # Flags are small non-negative integers
+            if is_flag and np.all( ( vals >= 0 ) & ( vals <= 255 ) &
+                    ( vals % 1 == 0 )):
+                col = col.astype( 'UInt8' )
+            elif col.dtype.kind == 'f':
+                col = col.astype( np.float32 )
+        elif col.dtype == object:
+            # Repeated text (e.g. season names, site codes)
+            if col.nunique() <= len( col ) // 2:
+                col = col.astype( 'category' )
+        compact_cols[ i ] = col
+    compact_df = pd.DataFrame( compact_cols, index=df.index )
+    compact_df.columns = df.columns
+
+    if verbose:
+        after = compact_df.memory_usage( deep=True ).sum()
+        print( 'Compacted frame: {0:.1f} MB -> {1:.1f} MB ({2:.0f}% saved)'
+                .format( before / 1e6, after / 1e6,
+                    100 * ( 1 - after / max( before, 1 ))))
+
+    return compact_df
+
+
+# Extensions of compressed data files (read_csv decompresses these by
+# extension as it parses)
+compressed_exts = ( '.gz', '.bz2', '.xz', '.zst' )
+
+
+def find_compressed( fname ) :
+    """
+    Return fname if it exists, otherwise the first compressed sibling of it
+    (fname + '.gz', '.bz2', '.xz' or '.zst') that exists. If there is no
+    such file fname is returned unchanged.
+    """
+    if os.path.exists( fname ):
+        return fname
+    for ext in compressed_exts:
+        if os.path.exists( fname + ext ):
+            return fname + ext
+    return fname
+
+
+def _open_text( fname ) :
+    """
+    Open a plain or compressed (by extension) data file for reading text
+    """
+    if fname.endswith( '.gz' ):
+        return gzip.open( fname, 'rt' )
+    elif fname.endswith( '.bz2' ):
+        return bz2.open( fname, 'rt' )
+    elif fname.endswith( '.xz' ):
+        return lzma.open( fname, 'rt' )
+    elif fname.endswith( '.zst' ):
+        # zstandard is optional (it is only needed for .zst files)
+        import zstandard
+        return io.TextIOWrapper( zstandard.ZstdDecompressor().stream_reader(
+            open( fname, 'rb' ), closefd=True ))
+    return open( fname, 'r' )
+
+
+def _select_usecols( fname, columns, ndate, rename={}, date_names=(),
+        **read_kwargs ) :
+    """
+    Read only the header of a file and return the positions of the
+    timestamp fields (the first ndate columns or columns named in
+    date_names) plus the requested columns. Header names are matched
+    after applying rename, so new-format names can be requested from
+    old-format files. Returns None (all columns) if columns is None.
+    """
+    if columns is None:
+        return None
+    names = pd.read_csv( fname, nrows=0, **read_kwargs ).columns
+    return [ i for i, n in enumerate( names ) if i < ndate or
+            n in date_names or rename.get( n, n ) in columns ]
+
+
+def _datetime_from_fields( fields ) :
+    """
+    Make a DatetimeIndex from a DataFrame whose first six columns are
+    integer year, month, day, hour, minute and second fields.
+    """
+    fields = fields.iloc[ :, 0:6 ].astype( np.int64 )
+    fields.columns = [ 'year', 'month', 'day', 'hour', 'minute', 'second' ]
+    return pd.DatetimeIndex( pd.to_datetime( fields ), name='tstamp' )
+
+
+# Old (2007-2008) AF column names and their new-format equivalents
+aflx_old_to_new = {
+    'FC':'FC_F', 'Rg':'SW_IN_F', 'Rg_out':'SW_OUT', 'LE':'LE_F',
+    'Rlong_in':'LW_IN', 'Rlong_out':'LW_OUT', 'VPD':'VPD_F',
+    'RH':'RH_F','PRECIP':'P_F', 'TA':'TA_F', 'RE':'RECO',
+    'FC_flag':'FC_F_FLAG', 'H':'H_F', 'RNET':'RNET_F'}
+
+
+def parse_old_aflx_dates( yr, doy, hhmm, year ) :
+    """
+    Convert the YEAR, DOY and HRMIN columns of an old format AF file
+    (2007-2008) to a DatetimeIndex. Works on whole columns with integer
+    arithmetic instead of building a datetime for each row.
+
+    Args:
+        yr (array)      : integer years
+        doy (array)     : integer days of year
+        hhmm (array)    : integer hour/minute (HHMM, zero padding optional)
+        year (int)      : year of the ameriflux file
+
+    Return:
+        idx         : pandas DatetimeIndex named 'Date'
+    """
+    yr = np.asarray( yr, dtype=np.int64 )
+    doy = np.asarray( doy, dtype=np.int64 )
+    hhmm = np.asarray( hhmm, dtype=np.int64 )
+    # Some files have a line of zeros at the end - send these to 1955 so
+    # they are trimmed with the other irregular data
+    yr = np.where( yr != year, 1955, yr )
+    # Dec 31 of the previous year, plus days, hours and minutes
+    dec31 = (( yr - 1970 ).astype( 'datetime64[Y]' ).astype( 'datetime64[m]' )
+            - np.timedelta64( 1, 'D' ))
+    minutes = doy * 1440 + ( hhmm // 100 ) * 60 + hhmm % 100
+    return pd.DatetimeIndex( dec31 + minutes.astype( 'timedelta64[m]' ),
+            name='Date' )
+
+
+# Layouts of the two AF file formats when the format is not sniffed
+aflx_formats = {
+    'legacy' : { 'layout' : 'legacy', 'skiprows' : ( 0,1,2,4 ),
+        'delimiter' : ',', 'na_value' : '-9999', 'convention' : 'old' },
+    'iso' : { 'layout' : 'iso', 'skiprows' : ( 0,1,2,3,4,5,7 ),
+        'delimiter' : ',', 'na_value' : '-9999', 'convention' : 'new' }}
+
+
+def sniff_aflx_format( fname, nlines=20 ) :
+    """
+    Identify the format of an ameriflux file from its first few lines
+    (the rest of the file is not read). Compressed files are read too.
+
+    Args:
+        fname (str)     : path and filename of AF file
+        nlines (int)    : number of lines to look at
+
+    Return:
+        fmt (dict)  : 'layout' ('legacy' for YEAR/DOY/HRMIN date columns or
+                      'iso' for a TIMESTAMP column), 'skiprows' (metadata
+                      and units rows to skip), 'delimiter', 'na_value'
+                      (missing value sentinel) and 'convention' ('old' or
+                      'new' column names)
+    """
+    with _open_text( find_compressed( fname )) as fin:
+        lines = [ l.rstrip( '\r\n' ) for l in itertools.islice( fin, nlines )]
+
+    # Find the header line and the delimiter
+    for hrow, line in enumerate( lines ):
+        delim = '\t' if line.count( '\t' ) > line.count( ',' ) else ','
+        names = [ n.strip().strip( '"' ) for n in line.split( delim )]
+        if names[ 0 ].upper() == 'YEAR' and len( names ) > 2:
+            layout = 'legacy'
+            break
+        if names[ 0 ].upper().startswith( 'TIMESTAMP' ):
+            layout = 'iso'
+            break
+    else:
+        raise ValueError( 'Unrecognized ameriflux file format: ' + fname )
+
+    # Missing value sentinel (look for it in metadata and the first rows)
+    na_value = '-9999'
+    for line in lines[ :hrow ] + lines[ hrow + 2: ]:
+        m = re.search( r'(?<![\d.])(-9999|-6999)(?:\.0+)?(?![\d.])', line )
+        if m:
+            na_value = m.group( 1 )
+            break
+
+    # Old column names are the keys of the rename map
+    if any( n in aflx_old_to_new for n in names ):
+        convention = 'old'
+    else:
+        convention = 'new'
+
+    # Skip metadata rows above the header and the units row below it
+    skiprows = tuple( range( hrow )) + ( hrow + 1, )
+
+    return { 'layout' : layout, 'skiprows' : skiprows, 'delimiter' : delim,
+            'na_value' : na_value, 'convention' : convention }
+
+
+def load_aflx_file( fname, year, old_date_parse=None, columns=None,
+        compact=False ) :
     """
     Load a specified ameriflux file and return a pandas DataFrame object.
     DataFrame has a datetime index and has been reindexed to include all
@@ -23,49 +335,63 @@ def load_aflx_file( fname, year, old_date_parse=False ) :
     new format.
     
     Args:
-        fname (str) : path and filename of desired AF file
+        fname (str) : path and filename of desired AF file (if it doesn't
+                      exist, a .gz, .bz2, .xz or .zst copy is read)
         year (int)  : year of ameriflux file
+        old_date_parse (bool) : true=file is in the old AF format,
+                         false=new format, None=detect the format from the
+                         file header (see sniff_aflx_format)
+        columns (list) : optional list of (new format) column names to
+                         parse. Other columns are not read.
+        compact (bool) : true=convert to compact dtypes (see compact_frame)
 
     Return:
         parsed_df   : pandas DataFrame    
     """
-    # a date parser for older AF files (2007-2008)
-    def dparse1( yr, doy, hhmm ):       
-        yr = int( yr )
-        # Some files have a line of zeros at the end - hack it
-        if yr != year:
-            yr = 1955
-
-        hhmm = hhmm.zfill( 4 )
-        doy = int( doy )
-        return ( dt.datetime( yr - 1, 12, 31 ) + 
-                dt.timedelta( days=doy, hours=int( hhmm[ 0:2 ] ),
-                    minutes=int( hhmm[2:4] )))
-        
+    fname = find_compressed( fname )
     print('Parsing ' + fname)
 
+    if old_date_parse is None:
+        fmt = sniff_aflx_format( fname )
+    elif old_date_parse:
+        fmt = aflx_formats[ 'legacy' ]
+    else:
+        fmt = aflx_formats[ 'iso' ]
+    read_kw = dict( skiprows=fmt[ 'skiprows' ], header=0,
+            delimiter=fmt[ 'delimiter' ])
+    if fmt[ 'convention' ] == 'old':
+        rename = aflx_old_to_new
+    else:
+        rename = {}
+
     # The old files, which we are still using for now, have different date
     # columns and variable names, so they need to be parsed a little
     # differently and converted.
-    if old_date_parse:
-        # Use old date parser
-        parsed_df =  pd.read_csv( fname, skiprows=( 0,1,2,4 ), header=0,
-                parse_dates={ 'Date':[ 0, 1, 2 ] }, date_parser=dparse1,
-                na_values='-9999', index_col='Date' )
-        # Rename old columns to new format
-        parsed_df.rename(columns={ 
-            'FC':'FC_F', 'Rg':'SW_IN_F', 'Rg_out':'SW_OUT', 'LE':'LE_F',
-            'Rlong_in':'LW_IN', 'Rlong_out':'LW_OUT', 'VPD':'VPD_F',
-            'RH':'RH_F','PRECIP':'P_F', 'TA':'TA_F', 'RE':'RECO',
-            'FC_flag':'FC_F_FLAG', 'H':'H_F', 'RNET':'RNET_F'}, 
-            inplace=True)
+    if fmt[ 'layout' ] == 'legacy':
+        # Read date columns as plain integers and convert them in one pass
+        usecols = _select_usecols( fname, columns, 3, rename=rename,
+                **read_kw )
+        parsed_df =  pd.read_csv( fname, na_values=fmt[ 'na_value' ],
+                usecols=usecols, **read_kw )
+        parsed_df.index = parse_old_aflx_dates( parsed_df.iloc[ :, 0 ],
+                parsed_df.iloc[ :, 1 ], parsed_df.iloc[ :, 2 ], year )
+        parsed_df = parsed_df.iloc[ :, 3: ]
 
     else:
         # Use ISO date parse
-        parsed_df =  pd.read_csv( fname, skiprows=( 0,1,2,3,4,5,7 ), header=0,
-                parse_dates={ 'Date': [0] },
-                na_values='-9999', index_col='Date' )
+        usecols = _select_usecols( fname, columns, 1, rename=rename,
+                **read_kw )
+        parsed_df =  pd.read_csv( fname, parse_dates={ 'Date': [0] },
+                usecols=usecols, na_values=fmt[ 'na_value' ],
+                index_col='Date', **read_kw )
+
+    # Rename old columns to new format
+    if rename:
+        parsed_df.rename(columns=rename, inplace=True)
 
+    # Put requested columns in order (missing ones are all NaN)
+    if columns is not None:
+        parsed_df = parsed_df.reindex( columns=columns )
 
     # We will reindex to include every 30-min period during the given year,
     # from YR-01-01 00:30 to YR+1-01-01 00:00
@@ -79,6 +405,8 @@ def load_aflx_file( fname, year, old_date_parse=False ) :
         print( "WARNING: some observations may be missing!" )
     
     parsed_df = parsed_df.reindex( full_idx )
+    if compact:
+        parsed_df = compact_frame( parsed_df )
     
     return parsed_df
 
@@ -156,7 +484,9 @@ def load_local_file( fname, yrtrim=None ) :
 
 def get_multiyr_aflx( site, afpath,
                       startyear=now.year - 1, endyear=now.year - 1,
-                      gapfilled=True, old_dparse=False ) :
+                      gapfilled=True, old_dparse=None, cache=None,
+                      columns=None, compact=False, catalog=None,
+                      mirror=None ) :
     """
     Load a list of 1-year ameriflux files, append them, and then return
     a pandas DataFrame object of AF data from startyear to endyear.
@@ -167,42 +497,98 @@ def get_multiyr_aflx( site, afpath,
         startyear   : First year of data to include
         endyear     : Last year of data to include
         gapfilled   : Boolean, true=with_gaps, false=gapfilled files parsed
-        old_dparse  : Boolean, true=use old AF date parsing, false=new parsing
+        old_dparse  : Boolean, true=use old AF date parsing, false=new parsing,
+                      None=detect the format of each file (default)
+        cache       : optional cache_nmeg.FrameCache for parsed year files
+        columns     : optional list of (new format) columns to parse
+        compact     : Boolean, true=use compact dtypes (see compact_frame)
+        catalog     : optional catalog_nmeg.DataCatalog to find files with
+        mirror      : optional mirror_nmeg.Mirror to read files through (the
+                      next year's file is copied while one is parsed)
 
     Return:
         site_df     : pandas DataFrame containing multiple years of AF data
                       from one site
     """
-    
-    if gapfilled:
-        file_gap_type = 'gapfilled'
-    else:
-        file_gap_type = 'with_gaps'
-        
-    # Get a list of filenames in the directory
-    file_list = os.listdir( afpath )
-    # Select desired files from file_list (by site and gapfilling)
-    site_file_list = [ s for s in file_list if site in s ]
-    site_file_list = [ s for s in site_file_list if file_gap_type in s ]
-    # Initialize DataFrame
-    site_df = pd.DataFrame()
+    # Find the file for each year
+    year_files, empty_yrs = _aflx_year_files( site, afpath, startyear,
+            endyear, gapfilled, catalog )
+    # Initialize list of 1-year DataFrames
+    year_frames = []
     # Loop through each year and fill the dataframe
+    for j, fpath in mirror_nmeg.iter_local( year_files, mirror ):
+        # Call load_aflx_file
+        year_df = _cached_load( load_aflx_file, fpath, cache=cache,
+                year=j, old_date_parse=old_dparse, columns=columns,
+                compact=compact )
+        year_frames.append( year_df )
+
+    # Now put the years into one DataFrame on the standard index
+    newidx = _aflx_multiyr_index( startyear, endyear, empty_yrs )
+    site_df = assemble_multiyr( year_frames, newidx )
+
+    return site_df
+
+
+def _find_year_files( dpath, year_names, catalog=None, product=None,
+        site=None, variant='' ) :
+    """
+    Find the file for each year in a data directory. year_names is a dict
+    of {year : expected filename}. If a catalog (catalog_nmeg.DataCatalog)
+    is given, files are looked up in it by product, site, year and variant
+    instead of listing dpath. A compressed sibling of the expected file
+    (see compressed_exts) is used if the plain file is not there. Returns
+    a dict of {year : path} for years with a file and a list of years
+    without one.
+    """
+    if catalog is None:
+        # Get a list of filenames in the directory
+        file_list = set( os.listdir( dpath ))
+    year_files = {}
     empty_yrs = list() # to be filled with years that have no file
-    for j in range(startyear, endyear + 1):
-        fName = '{0}_{1}_{2}.txt'.format( site, j, file_gap_type )
-        # If theres is a file for that year, load it
-        if fName in site_file_list:
-            # Call load_aflx_file
-            year_df = load_aflx_file( afpath + fName, j, 
-                    old_date_parse=old_dparse )
-            # And append to site_df
-            site_df = site_df.append( year_df, verify_integrity=True  )
+    for j, fName in year_names.items():
+        if catalog is None:
+            fpath = None
+            for ext in ( '', ) + compressed_exts:
+                if fName + ext in file_list:
+                    fpath = dpath + fName + ext
+                    break
+        else:
+            fpath = catalog.find( dpath, product, site, j, variant )
+        # If theres is a file for that year, keep it
+        if fpath is not None:
+            year_files[ j ] = fpath
         else:
             # Add empty year so we can trim data
             empty_yrs.append(j)
             print( 'WARNING: ' + fName + ' is missing')
+
+    return year_files, empty_yrs
+
+
+def _aflx_year_files( site, afpath, startyear, endyear, gapfilled,
+        catalog=None ) :
+    """
+    Find the AF file for each year of a site. Returns a dict of
+    {year : path} for years with a file and a list of years without one.
+    """
+    if gapfilled:
+        file_gap_type = 'gapfilled'
+    else:
+        file_gap_type = 'with_gaps'
+        
+    year_names = { j : '{0}_{1}_{2}.txt'.format( site, j, file_gap_type )
+            for j in range( startyear, endyear + 1 )}
+    return _find_year_files( afpath, year_names, catalog, 'aflx', site,
+            file_gap_type )
+
+
+def _aflx_multiyr_index( startyear, endyear, empty_yrs ) :
+    """
+    Make the 30 minute index for multi-year AF data, starting with the
+    first year that has a file.
+    """
     # Get non empty years
-    #pdb.set_trace()
     non_empty = [x for x in range(startyear, endyear) if x not in empty_yrs]
     if len(non_empty) > 0:
         # Create index spanning all days in min(non_empty) to endyear
@@ -212,15 +598,189 @@ def get_multiyr_aflx( site, afpath,
         newidx = pd.date_range( str( startyear ) + '-01-01 00:30:00',
                 str( endyear + 1 ) + '-01-01 00:00:00', freq = '30T')
 
-    # Now standardize the time period and index of site_df
-    idxyrs = site_df.index.year > startyear - 1;
-    site_df = site_df.iloc[ idxyrs, : ]
-    site_df = site_df.reindex( newidx )
+    return newidx
 
-    return site_df
 
+def get_multisite_aflx( sites, afpath,
+                        startyear=now.year - 1, endyear=now.year - 1,
+                        gapfilled=True, old_dparse=None, site_prefix='',
+                        workers=None, use_threads=False, verbose=True,
+                        cache=None, columns=None, compact=False,
+                        catalog=None ) :
+    """
+    Load multi-year ameriflux data for a list of sites, parsing the 1-year
+    files in parallel. Returns the same DataFrames as calling
+    get_multiyr_aflx for each site, in a dict with site keys.
+
+    Args:
+        sites       : List of site names
+        afpath      : Path to directory of ameriflux files
+        startyear   : First year of data to include
+        endyear     : Last year of data to include
+        gapfilled   : Boolean, true=with_gaps, false=gapfilled files parsed
+        old_dparse  : Boolean, true=use old AF date parsing, false=new parsing,
+                      None=detect the format of each file (default)
+        site_prefix : String added to site names to make AF file names
+                      (e.g. 'US-' when sites are ['Seg', 'Ses', ...])
+        workers     : Number of worker processes/threads (default is the
+                      number of CPUs). workers=1 parses files serially.
+        use_threads : Boolean, true=use a thread pool instead of processes
+        verbose     : Boolean, false=don't print a message for each file
+        cache       : optional cache_nmeg.FrameCache for parsed year files
+        columns     : optional list of (new format) columns to parse
+        compact     : Boolean, true=use compact dtypes (see compact_frame)
+        catalog     : optional catalog_nmeg.DataCatalog to find files with
 
-def load_fluxall_file( fname, year ) :
+    Return:
+        site_dict   : dict of pandas DataFrames (one per site)
+    """
+    # Find files for every site and year
+    tasks = []
+    empty_yrs = {}
+    for site in sites:
+        year_files, empty_yrs[ site ] = _aflx_year_files( site_prefix + site,
+                afpath, startyear, endyear, gapfilled, catalog )
+        tasks.extend([ ( site, j, fpath ) for j, fpath in year_files.items() ])
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max( 1, min( workers, len( tasks )))
+
+    # Parse the files (workers return arrays, not DataFrames). Worker
+    # processes silence their own output, but serial and threaded parsing
+    # share stdout with this process, so silence it here.
+    results = {}
+    if verbose or ( workers > 1 and not use_threads ):
+        quiet = contextlib.nullcontext()
+    else:
+        quiet = contextlib.redirect_stdout( io.StringIO() )
+    with quiet:
+        if workers == 1:
+            for site, j, fpath in tasks:
+                results[ ( site, j ) ] = _aflx_year_worker( fpath, j,
+                        old_dparse, True, cache, columns, compact )
+        else:
+            if use_threads:
+                pool = cf.ThreadPoolExecutor( max_workers=workers )
+            else:
+                pool = cf.ProcessPoolExecutor( max_workers=workers )
+            with pool:
+                futures = { pool.submit( _aflx_year_worker, fpath, j,
+                    old_dparse, verbose or use_threads, cache, columns,
+                    compact ) :
+                    ( site, j ) for site, j, fpath in tasks }
+                for fut in cf.as_completed( futures ):
+                    results[ futures[ fut ]] = fut.result()
+
+    # Rebuild the year frames and assemble each site
+    site_dict = {}
+    for site in sites:
+        year_frames = [ _frame_from_arrays( *results[ ( s, j ) ] )
+                for s, j, fpath in tasks if s == site ]
+        newidx = _aflx_multiyr_index( startyear, endyear, empty_yrs[ site ])
+        site_dict[ site ] = assemble_multiyr( year_frames, newidx )
+
+    return site_dict
+
+
+class LazySiteCollection( collections.abc.Mapping ) :
+    """
+    A read-only {site : DataFrame} mapping that loads each site the first
+    time it is accessed. It can be used wherever a dict of site DataFrames
+    is expected (e.g. transform_nmeg.get_var_allsites or
+    plot_nmeg.plot_tseries). Listing keys never loads data.
+
+    Changes made to a loaded DataFrame are lost if that site is dropped
+    and later reloaded.
+
+    Args:
+        sites (list)        : site names (the keys)
+        loader (callable)   : function taking a site name and returning
+                              its DataFrame
+        max_loaded (int)    : keep at most this many sites in memory,
+                              dropping the least recently used (default
+                              no limit)
+    """
+
+    def __init__( self, sites, loader, max_loaded=None ) :
+        self.sites = list( sites )
+        self.loader = loader
+        self.max_loaded = max_loaded
+        self._frames = collections.OrderedDict()
+
+    @classmethod
+    def aflx( cls, sites, afpath, site_prefix='US-', max_loaded=None,
+            **kwargs ) :
+        """
+        Make a collection that loads sites with get_multiyr_aflx. kwargs
+        (startyear, endyear, columns, compact, etc.) are passed on.
+        """
+        def loader( site ) :
+            return get_multiyr_aflx( site_prefix + site, afpath, **kwargs )
+        return cls( sites, loader, max_loaded=max_loaded )
+
+    def __getitem__( self, site ) :
+        if site in self._frames:
+            self._frames.move_to_end( site )
+            return self._frames[ site ]
+        if site not in self.sites:
+            raise KeyError( site )
+        site_df = self.loader( site )
+        self._frames[ site ] = site_df
+        if self.max_loaded is not None:
+            while len( self._frames ) > self.max_loaded:
+                self._frames.popitem( last=False )
+        return site_df
+
+    def __iter__( self ) :
+        return iter( self.sites )
+
+    def __len__( self ) :
+        return len( self.sites )
+
+    def __contains__( self, site ) :
+        return site in self.sites
+
+    def loaded( self ) :
+        """ List of sites currently in memory (least recently used first) """
+        return list( self._frames.keys() )
+
+    def drop( self, site=None ) :
+        """ Drop one site (or all sites) from memory """
+        if site is None:
+            self._frames.clear()
+        else:
+            self._frames.pop( site, None )
+
+
+def _aflx_year_worker( fname, year, old_dparse, verbose, cache,
+        columns=None, compact=False ) :
+    """
+    Parse one AF file in a worker and return it as compact arrays (index as
+    int64 nanoseconds, column names, and one array per column).
+    """
+    if verbose:
+        year_df = _cached_load( load_aflx_file, fname, cache=cache,
+                year=year, old_date_parse=old_dparse, columns=columns,
+                compact=compact )
+    else:
+        with contextlib.redirect_stdout( io.StringIO() ):
+            year_df = _cached_load( load_aflx_file, fname, cache=cache,
+                    year=year, old_date_parse=old_dparse, columns=columns,
+                    compact=compact )
+
+    return ( year_df.index.values.view( np.int64 ), list( year_df.columns ),
+            [ year_df[ c ].values for c in year_df.columns ])
+
+
+def _frame_from_arrays( index_ns, columns, values ) :
+    # Rebuild a DataFrame returned by a worker
+    idx = pd.DatetimeIndex( index_ns.view( 'datetime64[ns]' ))
+    return pd.DataFrame( dict( zip( range( len( columns )), values )),
+            index=idx ).set_axis( columns, axis=1 )
+
+
+def load_fluxall_file( fname, year, columns=None, compact=False ) :
     """
     Load a specified fluxall file and return a pandas DataFrame object.
     DataFrame has a datetime index and has been reindexed to include all
@@ -229,26 +789,23 @@ def load_fluxall_file( fname, year ) :
     Args:
         fname (str) : path and filename of desired file
         year (int)  : year of file
+        columns (list) : optional list of column names to parse. Other
+                         columns are not read.
+        compact (bool) : true=convert to compact dtypes (see compact_frame)
 
     Return:
         parsed_df   : pandas DataFrame    
     """
-    def dparser( y, m, d, H, M, S ):
-        yr = int( y )
-        mon = int( m )
-        day = int( d )
-        hr = int( H )
-        mn =  int( M )
-        sec = int( S )
-        
-        return ( dt.datetime( yr, mon, day, hr, mn, sec ))
-    
+    fname = find_compressed( fname )
     print('Parsing ' + fname)
 
-    # Use date parser above
-    parsed_df =  pd.read_csv(fname, delimiter='\t',
-                parse_dates={'tstamp':[0, 1, 2, 3, 4, 5]},
-                date_parser=dparser, index_col='tstamp')
+    # Read the file and make the index from the 6 date/time fields
+    usecols = _select_usecols( fname, columns, 6, delimiter='\t' )
+    parsed_df =  pd.read_csv(fname, delimiter='\t', usecols=usecols)
+    parsed_df.index = _datetime_from_fields( parsed_df )
+    parsed_df = parsed_df.iloc[ :, 6: ]
+    if columns is not None:
+        parsed_df = parsed_df.reindex( columns=columns )
 
 
     # We will reindex to include every 30-min period during the given year,
@@ -263,12 +820,44 @@ def load_fluxall_file( fname, year ) :
         print( "WARNING: some observations may be missing!" )
     
     parsed_df = parsed_df.reindex( full_idx )
+    if compact:
+        parsed_df = compact_frame( parsed_df )
     
     return parsed_df
 
 
+def iter_fluxall_file( fname, chunksize=4800, columns=None ) :
+    """
+    Read a fluxall file in chunks of rows. Each chunk is yielded as a
+    pandas DataFrame with a parsed datetime index, so data can be
+    aggregated without holding the whole file in memory. Chunks are not
+    reindexed.
+
+    Args:
+        fname (str)     : path and filename of desired file
+        chunksize (int) : number of rows in each chunk
+        columns (list)  : optional list of column names to parse
+
+    Return:
+        generator of pandas DataFrames
+    """
+    print('Streaming ' + fname)
+    usecols = _select_usecols( fname, columns, 6, delimiter='\t' )
+    reader = pd.read_csv(fname, delimiter='\t', usecols=usecols,
+            chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            chunk.index = _datetime_from_fields( chunk )
+            chunk = chunk.iloc[ :, 6: ]
+            if columns is not None:
+                chunk = chunk.reindex( columns=columns )
+            yield chunk
+
+
 def get_multiyr_fluxall( site, base_path,
-                      startyear=now.year - 1, endyear=now.year - 1 ) :
+                      startyear=now.year - 1, endyear=now.year - 1,
+                      cache=None, columns=None, compact=False,
+                      catalog=None, mirror=None ) :
     """
     Load a list of 1-year fluxall files, append them, and then return
     a pandas DataFrame object of fluxall data from startyear to endyear.
@@ -278,78 +867,81 @@ def get_multiyr_fluxall( site, base_path,
         base_path   : Path to base directory of fluxall files (subdir for sites)
         startyear   : First year of data to include
         endyear     : Last year of data to include
+        cache       : optional cache_nmeg.FrameCache for parsed year files
+        columns     : optional list of columns to parse
+        compact     : Boolean, true=use compact dtypes (see compact_frame)
+        catalog     : optional catalog_nmeg.DataCatalog to find files with
+        mirror      : optional mirror_nmeg.Mirror to read files through (the
+                      next year's file is copied while one is parsed)
 
     Return:
         site_df     : pandas DataFrame containing multiple years of data
                       from one site
     """
-    dpath = base_path + site + '/'
-  
     # Create empty dataframe spanning all days in  startyear to endyear
     newidx = pd.date_range( str( startyear ) + '-01-01 00:30:00',
             str( endyear + 1 ) + '-01-01 00:00:00', freq = '30T')
-    df = pd.DataFrame( index = newidx )
 
-    # Get a list of filenames in the directory
-    file_list = os.listdir( dpath )
-
-    # Select desired files from file_list (by site and filetype)
-    site_file_list = [ s for s in file_list if site in s ]
-    site_file_list = [ s for s in site_file_list if 'fluxall' in s ]
-    # Initialize DataFrame
-    site_df = pd.DataFrame()
+    # Find the file for each year
+    year_files, empty_yrs = _fluxall_year_files( site, base_path, startyear,
+            endyear, catalog )
+    # Initialize list of 1-year DataFrames
+    year_frames = []
     # Loop through each year and fill the dataframe
-    for j in range(startyear, endyear + 1):
-        fName = '{0}_{1}_fluxall.txt'.format( site, j )
-        # If theres is a file for that year, load it
-        if fName in site_file_list:
-            # Call load_fluxall_file
-            year_df = load_fluxall_file( dpath + fName, j )
-            # And append to site_df
-            site_df = site_df.append( year_df, verify_integrity=True  )
-        else:
-            print( 'WARNING: ' + fName + ' is missing')
+    for j, fpath in mirror_nmeg.iter_local( year_files, mirror ):
+        # Call load_fluxall_file
+        year_df = _cached_load( load_fluxall_file, fpath,
+                cache=cache, year=j, columns=columns, compact=compact )
+        year_frames.append( year_df )
 
-    # Now standardize the time period and index of site_df and put
-    # multiyear site flux values in measurement-specific dataframe
-    idxyrs = site_df.index.year > startyear - 1;
-    site_df = site_df.iloc[ idxyrs, : ]
-    site_df = site_df.reindex( newidx )
+    # Now put the years into one DataFrame on the standard index
+    site_df = assemble_multiyr( year_frames, newidx )
 
     return site_df
 
 
-def load_soilmet_qc(fname):
+def _fluxall_year_files( site, base_path, startyear, endyear, catalog=None ) :
+    """
+    Find the fluxall file for each year of a site (see _find_year_files)
+    """
+    year_names = { j : '{0}_{1}_fluxall.txt'.format( site, j )
+            for j in range( startyear, endyear + 1 )}
+    return _find_year_files( base_path + site + '/', year_names, catalog,
+            'fluxall', site )
+
+
+def load_soilmet_qc(fname, columns=None, compact=False):
     """
     Load a specified soilmet file and return a pandas DataFrame object.
     DataFrame has a datetime index
     Args:
         fname (str) : path and filename of desired file
-        year (int)  : year of file
+        columns (list) : optional list of column names to parse. Other
+                         columns are not read.
+        compact (bool) : true=convert to compact dtypes (see compact_frame)
 
     Return:
         parsed_df   : pandas DataFrame 
     """
-    def dparser( y, m, d, H, M, S ):
-        yr = int( y )
-        mon = int( m )
-        day = int( d )
-        hr = int( H )
-        mn =  int( M )
-        sec = int( S )
-        return ( dt.datetime( yr, mon, day, hr, mn, sec ))
-    
+    fname = find_compressed( fname )
     print('Parsing ' + fname)
 
-    soilmet_df = pd.read_csv(fname, delimiter=',', 
-                parse_dates={'tstamp':[0, 1, 2, 3, 4, 5]},
-                date_parser=dparser, index_col='tstamp')
+    # Read the file and make the index from the 6 date/time fields
+    usecols = _select_usecols( fname, columns, 6, delimiter=',' )
+    soilmet_df = pd.read_csv(fname, delimiter=',', usecols=usecols)
+    soilmet_df.index = _datetime_from_fields( soilmet_df )
+    soilmet_df = soilmet_df.iloc[ :, 6: ]
+    if columns is not None:
+        soilmet_df = soilmet_df.reindex( columns=columns )
+    if compact:
+        soilmet_df = compact_frame( soilmet_df )
 
     return(soilmet_df)
 
 
 def get_multiyr_soilmet(site, base_path, ext='qc',
-        startyear=now.year - 1, endyear=now.year ) :
+        startyear=now.year - 1, endyear=now.year, cache=None,
+        columns=None, compact=False, catalog=None, mirror=None ) :
     """
     Load a list of 1-year soilmet files, append them, and then return
     a pandas DataFrame object of soilmet data from startyear to endyear.
@@ -360,6 +952,12 @@ def get_multiyr_soilmet(site, base_path, ext='qc',
         ext         : File type ('qc', 'qc_rbd', or 'qc_rbd_gf')
         startyear   : First year of data to include
         endyear     : Last year of data to include
+        cache       : optional cache_nmeg.FrameCache for parsed year files
+        columns     : optional list of columns to parse
+        compact     : Boolean, true=use compact dtypes (see compact_frame)
+        catalog     : optional catalog_nmeg.DataCatalog to find files with
+        mirror      : optional mirror_nmeg.Mirror to read files through (the
+                      next year's file is copied while one is parsed)
 
     Return:
         site_df     : pandas DataFrame containing multiple years of data
@@ -371,36 +969,37 @@ def get_multiyr_soilmet(site, base_path, ext='qc',
     newidx = pd.date_range( str( startyear ) + '-01-01 00:30:00',
             str( endyear + 1 ) + '-01-01 00:00:00', freq = '30T')
 
-    # Get a list of filenames in the directory
-    file_list = os.listdir( base_path )
+    # Find the file for each year
+    year_files, empty_yrs = _soilmet_year_files( site, base_path, ext,
+            startyear, endyear, catalog )
 
-    # Select desired files from file_list (by site and filetype)
-    site_file_list = [ s for s in file_list if site in s ]
-    filetype = ext + '.txt' # qc, qc_rbd, or qc_rbd_gf
-    site_file_list = [ s for s in site_file_list if filetype in s ]
-
-    # Initialize DataFrame
-    site_df = pd.DataFrame()
+    # Initialize list of 1-year DataFrames
+    year_frames = []
     # Loop through each year and fill the dataframe
-    for j in range(startyear, endyear + 1):
-        fName = '{0}_{1}_soilmet_{2}.txt'.format( site, j, ext )
-        # If theres is a file for that year, load it
-        if fName in site_file_list:
-            # Call load_soilmet_file
-            year_df = load_soilmet_qc( base_path + fName )
-            # And append to site_df
-            site_df = site_df.append( year_df, verify_integrity=True )
-        else:
-            print( 'WARNING: ' + fName + ' is missing')
+    for j, fpath in mirror_nmeg.iter_local( year_files, mirror ):
+        # Call load_soilmet_file
+        year_df = _cached_load( load_soilmet_qc, fpath,
+                cache=cache, columns=columns, compact=compact )
+        year_frames.append( year_df )
 
-    # Now standardize the time period and index of site_df
-    idxyrs = site_df.index.year > startyear - 1;
-    site_df = site_df.iloc[ idxyrs, : ]
-    site_df = site_df.reindex( newidx )
+    # Now put the years into one DataFrame on the standard index
+    site_df = assemble_multiyr( year_frames, newidx )
 
     return site_df
 
 
+def _soilmet_year_files( site, base_path, ext, startyear, endyear,
+        catalog=None ) :
+    """
+    Find the soilmet file (ext is qc, qc_rbd, or qc_rbd_gf) for each year
+    of a site (see _find_year_files)
+    """
+    year_names = { j : '{0}_{1}_soilmet_{2}.txt'.format( site, j, ext )
+            for j in range( startyear, endyear + 1 )}
+    return _find_year_files( base_path, year_names, catalog, 'soilmet',
+            site, ext )
+
+
 def loadPRISMfile(fname) :
     """
     Load a daily PRISM data file (found in ancillary_met_data file)
@@ -416,20 +1015,250 @@ def loadPRISMfile(fname) :
             parse_dates = True, index_col='date');
 
 
-def load_toa5_file(fname) :
+def load_toa5_file(fname, columns=None, compact=False) :
     """
     Load a toa5 data file (raw ascii datalogger files)
     
     Args:
         fname (str) : the full file path and name
+        columns (list) : optional list of column names to parse. Other
+                         columns are not read.
+        compact (bool) : true=convert to compact dtypes (see compact_frame)
 
     Return:
         df : pandas data frame 
     """       
-        
-    return pd.read_csv(fname, skiprows=( 0,2,3 ), header=0,
+    fname = find_compressed( fname )
+    usecols = _select_usecols( fname, columns, 0, date_names=('TIMESTAMP',),
+            skiprows=( 0,2,3 ), header=0 )
+    df = pd.read_csv(fname, skiprows=( 0,2,3 ), header=0,
             parse_dates = { 'Date': ['TIMESTAMP']}, index_col='Date',
-            na_values=['NaN', 'NAN', 'INF', '-INF']);
+            na_values=['NaN', 'NAN', 'INF', '-INF'], usecols=usecols);
+    if columns is not None:
+        df = df.reindex( columns=columns )
+    if compact:
+        df = compact_frame( df )
+    return df
+
+
+def iter_toa5_file(fname, chunksize=10000, columns=None) :
+    """
+    Read a toa5 data file (raw ascii datalogger files) in chunks of rows.
+    The TOA5 header rows are skipped before chunking, so every chunk holds
+    only data records. Each chunk is yielded as a pandas DataFrame with a
+    parsed datetime index.
+
+    Args:
+        fname (str)     : the full file path and name
+        chunksize (int) : number of rows in each chunk
+        columns (list)  : optional list of column names to parse
+
+    Return:
+        generator of pandas data frames
+    """
+    usecols = _select_usecols( fname, columns, 0, date_names=('TIMESTAMP',),
+            skiprows=( 0,2,3 ), header=0 )
+    reader = pd.read_csv(fname, skiprows=( 0,2,3 ), header=0,
+            na_values=['NaN', 'NAN', 'INF', '-INF'], usecols=usecols,
+            chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            chunk.index = pd.DatetimeIndex( pd.to_datetime(
+                chunk.pop( 'TIMESTAMP' )), name='Date' )
+            if columns is not None:
+                chunk = chunk.reindex( columns=columns )
+            yield chunk
+
+
+class TOA5Tail( object ) :
+    """
+    Incremental ingestion of a growing toa5 file (raw ascii datalogger
+    file). The byte offset of the end of the last complete record read,
+    the timestamp of that record, and the file header are kept in
+    store_dir along with the ingested data. Each call to update() checks
+    the header, parses only the records appended since the last call and
+    saves them as a new part (see cache_nmeg.save_frame), so polling a
+    logger file costs time in proportion to the new data.
+
+    If the file is shorter than the stored offset (the logger file was
+    replaced or reset) all stored parts are dropped and the file is read
+    again from the start.
+
+    Args:
+        fname (str)     : the full file path and name
+        store_dir (str) : directory for the state and data parts (created
+                          if needed)
+        columns (list)  : optional list of column names to parse
+
+    Attributes:
+        offset          : byte offset of the end of the last ingested record
+        last_tstamp     : timestamp of the last ingested record
+        nrows           : number of records ingested
+    """
+
+    def __init__( self, fname, store_dir, columns=None ) :
+        self.fname = fname
+        self.store_dir = store_dir
+        self.columns = columns
+        self._state_file = os.path.join( store_dir, 'toa5_state.json' )
+        if not os.path.isdir( store_dir ):
+            os.makedirs( store_dir )
+        self._reset()
+        if os.path.exists( self._state_file ):
+            with open( self._state_file ) as fin:
+                state = json.load( fin )
+            if ( state[ 'source' ] == os.path.abspath( fname ) and
+                    state[ 'columns' ] == columns ):
+                self.header = state[ 'header' ]
+                self.offset = state[ 'offset' ]
+                self.nrows = state[ 'nrows' ]
+                self.parts = state[ 'parts' ]
+                if state[ 'last_tstamp' ] is not None:
+                    self.last_tstamp = pd.Timestamp( state[ 'last_tstamp' ])
+            else:
+                self._drop_parts( state[ 'parts' ])
+
+    def _reset( self ) :
+        self.header = None
+        self.offset = 0
+        self.nrows = 0
+        self.parts = []
+        self.last_tstamp = None
+
+    def _drop_parts( self, parts ) :
+        for part in parts:
+            try:
+                os.remove( os.path.join( self.store_dir, part ))
+            except OSError:
+                pass
+
+    def update( self ) :
+        """
+        Ingest records appended to the file since the last update
+
+        Return:
+            df : pandas data frame of the new records (may be empty)
+        """
+        with open( self.fname, 'rb' ) as fin:
+            header = [ fin.readline().decode( 'utf-8' ).rstrip( '\r\n' )
+                    for i in range( 4 )]
+            hdr_end = fin.tell()
+            size = os.fstat( fin.fileno() ).st_size
+            if self.header is not None and size < self.offset:
+                print( 'WARNING: ' + self.fname + ' is shorter than the ' +
+                        'ingested data, reading it again' )
+                self._drop_parts( self.parts )
+                self._reset()
+            if self.header is None:
+                self.header = header
+                self.offset = hdr_end
+            elif header != self.header:
+                raise ValueError( 'TOA5 header of ' + self.fname +
+                        ' does not match the ingested data' )
+            fin.seek( self.offset )
+            data = fin.read()
+
+        # Only parse complete lines (the logger may be mid-write)
+        data = data[ :data.rfind( b'\n' ) + 1 ]
+        names = [ n.strip( '"' ) for n in self.header[ 1 ].split( ',' )]
+        if len( data ) == 0:
+            df = pd.DataFrame( columns=[ n for n in names if n != 'TIMESTAMP'
+                ] if self.columns is None else self.columns,
+                index=pd.DatetimeIndex( [], name='Date' ))
+            return df
+        print( 'Appending ' + str( len( data )) + ' bytes from ' + self.fname )
+        if self.columns is None:
+            usecols = None
+        else:
+            usecols = [ 'TIMESTAMP' ] + [ c for c in self.columns
+                    if c in names ]
+        df = pd.read_csv( io.BytesIO( data ), header=None, names=names,
+                na_values=['NaN', 'NAN', 'INF', '-INF'], usecols=usecols )
+        df.index = pd.DatetimeIndex( pd.to_datetime( df.pop( 'TIMESTAMP' )),
+                name='Date' )
+        if self.columns is not None:
+            df = df.reindex( columns=self.columns )
+        # Don't repeat records that were already ingested
+        if self.last_tstamp is not None:
+            df = df.loc[ df.index > self.last_tstamp, : ]
+
+        self.offset += len( data )
+        if len( df.index ) > 0:
+            part = self._part_name()
+            cache_nmeg.save_frame( os.path.join( self.store_dir, part ), df,
+                    source=self.fname )
+            self.parts.append( part )
+            self.nrows += len( df.index )
+            self.last_tstamp = df.index.max()
+        self._save_state()
+        return df
+
+    def frame( self ) :
+        """
+        Return all ingested records as one pandas data frame
+        """
+        if len( self.parts ) == 0:
+            return self.update()
+        dfs = [ cache_nmeg.load_frame( os.path.join( self.store_dir, p ))
+                for p in self.parts ]
+        return pd.concat( dfs )
+
+    def consolidate( self ) :
+        """
+        Merge all stored parts into one (keeps frame() fast after many
+        small updates)
+        """
+        if len( self.parts ) < 2:
+            return
+        df = self.frame()
+        part = self._part_name()
+        cache_nmeg.save_frame( os.path.join( self.store_dir, part ), df,
+                source=self.fname )
+        old_parts = self.parts
+        self.parts = [ part ]
+        self._save_state()
+        self._drop_parts( old_parts )
+
+    def _part_name( self ) :
+        # Parts are numbered in the order they are written
+        num = max([ int( p[ 4:-4 ]) for p in self.parts ] + [ -1 ]) + 1
+        return 'part{0:06d}.npz'.format( num )
+
+    def _save_state( self ) :
+        state = { 'source' : os.path.abspath( self.fname ),
+                'columns' : self.columns, 'header' : self.header,
+                'offset' : self.offset, 'nrows' : self.nrows,
+                'parts' : self.parts, 'last_tstamp' : None if
+                self.last_tstamp is None else str( self.last_tstamp )}
+        tmp = self._state_file + '.tmp'
+        with open( tmp, 'w' ) as fout:
+            json.dump( state, fout )
+        os.replace( tmp, self._state_file )
+
+
+def poll_toa5_files( fnames, store_path, columns=None ) :
+    """
+    Ingest new records from a list of growing toa5 files (see TOA5Tail).
+    Each file is stored in a subdirectory of store_path named after it and
+    a hash of its full path (so files with the same name in different site
+    directories have separate stores).
+
+    Args:
+        fnames (list)       : list of toa5 file paths
+        store_path (str)    : directory holding one store per file
+        columns (list)      : optional list of column names to parse
+
+    Return:
+        new_data (dict)     : data frame of new records for each file
+    """
+    new_data = {}
+    for fname in fnames:
+        path_hash = hashlib.sha1( os.path.abspath( fname ).encode(
+            'utf-8' )).hexdigest()[ :12 ]
+        store_dir = os.path.join( store_path, '{0}_{1}'.format(
+            os.path.splitext( os.path.basename( fname ))[ 0 ], path_hash ))
+        new_data[ fname ] = TOA5Tail( fname, store_dir, columns ).update()
+    return new_data
 
 
 def load_PJ_VWC_file(fname) :
@@ -447,7 +1276,30 @@ def load_PJ_VWC_file(fname) :
             parse_dates = [['year','month','mday']],
             index_col=2,na_values='NA');    
 
-def load_eddyproc_output( fname, year ) :
+def parse_eddyproc_dates( d, m, y, H, M ) :
+    """
+    Convert the Day, Month, Year, Hour and Minute columns of an MPI
+    eddyproc output file to a DatetimeIndex. The fields are combined with
+    integer datetime64 arithmetic (no string formatting or parsing).
+
+    Args:
+        d, m, y (array) : integer (or integral float) day, month and year
+        H, M (array)    : integer (or integral float) hour and minute
+
+    Return:
+        idx         : pandas DatetimeIndex named 'Date'
+    """
+    d, m, y, H, M = [ np.asarray( f ).astype( np.int64 )
+            for f in ( d, m, y, H, M )]
+    # First of the month, plus days, hours and minutes
+    month1 = ((( y - 1970 ) * 12 + m - 1 ).astype( 'datetime64[M]' )
+            .astype( 'datetime64[m]' ))
+    minutes = ( d - 1 ) * 1440 + H * 60 + M
+    return pd.DatetimeIndex( month1 + minutes.astype( 'timedelta64[m]' ),
+            name='Date' )
+
+
+def load_eddyproc_output( fname, year, columns=None, compact=False ) :
     """
     Load a specified eddyproc file and return a pandas DataFrame object.
     DataFrame has a datetime index and has been reindexed to include all
@@ -456,28 +1308,25 @@ def load_eddyproc_output( fname, year ) :
     Args:
         fname (str) : path and filename of desired AF file
         year (int)  : year of ameriflux file
+        columns (list) : optional list of column names to parse. Other
+                         columns are not read.
+        compact (bool) : true=convert to compact dtypes (see compact_frame)
 
     Return:
         parsed_df   : pandas DataFrame    
     """
-    # a date parser for older AF files (2007-2008)
-    def dparseMPI( d, m, y, H, M ):       
-        # MPI eddyproc sends back a crazy date format. Make a dataframe
-        # and then parse into a datetime
-        df = pd.DataFrame( dict(y = y.astype(float).astype(int), 
-                m = m.astype(float).astype(int),
-                d = d.astype(float).astype(int), 
-                H = H.astype(float).astype(int),
-                M = M.astype(float).astype(int)))
-        return pd.to_datetime( df.y*100000000 + df.m*1000000 + df.d*10000 
-                + df.H*100 + df.M, format='%Y%m%d%H%M')
-
-
     print('Parsing ' + fname)
-    parsed_df =  pd.read_csv( fname, skiprows=(1,), header=0,
-            delim_whitespace=True,# OR sep='\s+',
-            parse_dates={ 'Date': [ 0, 1, 2, 3, 4 ] }, date_parser=dparseMPI,
-            na_values='-9999', index_col='Date')
+    # MPI eddyproc sends back a crazy date format (Day, Month, Year, Hour
+    # and Minute columns). Read these as numbers and convert in one pass.
+    usecols = _select_usecols( fname, columns, 5, skiprows=(1,), header=0,
+            sep=r'\s+' )
+    parsed_df =  pd.read_csv( fname, skiprows=(1,), header=0, sep=r'\s+',
+            na_values='-9999', usecols=usecols )
+    parsed_df.index = parse_eddyproc_dates( *[ parsed_df.iloc[ :, i ]
+        for i in range( 5 )])
+    parsed_df = parsed_df.iloc[ :, 5: ]
+    if columns is not None:
+        parsed_df = parsed_df.reindex( columns=columns )
     
     # We will reindex to include every 30-min period during the given year,
     # from YR-01-01 00:30 to YR+1-01-01 00:00
@@ -491,6 +1340,8 @@ def load_eddyproc_output( fname, year ) :
         print( "WARNING: some observations may be missing!" )
     
     parsed_df = parsed_df.reindex( full_idx )
+    if compact:
+        parsed_df = compact_frame( parsed_df )
     
     return parsed_df
 
@@ -517,7 +1368,9 @@ def add_eddyproc_uncertainty( df, site, basepath, year, unc_vars=[] ) :
     return df_unc
 
 def get_multiyr_eddyproc( site, base_path, GL2010=False,
-                      startyear=now.year - 1, endyear=now.year - 1) :
+                      startyear=now.year - 1, endyear=now.year - 1,
+                      cache=None, columns=None, compact=False,
+                      catalog=None, mirror=None ) :
     """
     Load a list of 1-year eddyproc output files, append them, and then return
     a pandas DataFrame object of eddyproc data from startyear to endyear.
@@ -527,6 +1380,12 @@ def get_multiyr_eddyproc( site, base_path, GL2010=False,
         afpath      : Path to directory of ameriflux files
         startyear   : First year of data to include
         endyear     : Last year of data to include
+        cache       : optional cache_nmeg.FrameCache for parsed year files
+        columns     : optional list of columns to parse
+        compact     : Boolean, true=use compact dtypes (see compact_frame)
+        catalog     : optional catalog_nmeg.DataCatalog to find files with
+        mirror      : optional mirror_nmeg.Mirror to read files through (the
+                      next year's file is copied while one is parsed)
 
     Return:
         site_df     : pandas DataFrame containing multiple years of eddyproc 
@@ -536,32 +1395,206 @@ def get_multiyr_eddyproc( site, base_path, GL2010=False,
     newidx = pd.date_range( str( startyear ) + '-01-01 00:30:00',
             str( endyear + 1 ) + '-01-01 00:00:00', freq = '30T')
     
-    # Get a list of filenames in the directory
-    file_list = os.listdir( base_path + site )
+    # Find the file for each year
+    year_files, empty_yrs = _eddyproc_year_files( site, base_path, GL2010,
+            startyear, endyear, catalog )
+
+    # Initialize list of 1-year DataFrames
+    year_frames = []
+    # Loop through each year and fill the dataframe
+    for j, fpath in mirror_nmeg.iter_local( year_files, mirror ):
+        # Call load_eddyproc_output
+        year_df = _cached_load( load_eddyproc_output, fpath, cache=cache,
+                year=j, columns=columns, compact=compact )
+        year_frames.append( year_df )
+
+    # Now put the years into one DataFrame on the standard index
+    site_df = assemble_multiyr( year_frames, newidx )
+
+    return site_df
+
+
+def _eddyproc_year_files( site, base_path, GL2010, startyear, endyear,
+        catalog=None ) :
+    """
+    Find the eddyproc output file for each year of a site (see
+    _find_year_files)
+    """
     if GL2010:
-        file_list2 = [ s for s in file_list if 'GL2010' in s ]
         fName_base = 'DataSetafterFluxpartGL2010'
+        variant = 'GL2010'
     else:
-        file_list2 = [ s for s in file_list if 'GL2010' not in s ]
         fName_base = 'DataSetafterFluxpart'
+        variant = ''
+    year_names = { j : fName_base + '_{0}.txt'.format( j )
+            for j in range( startyear, endyear + 1 )}
+    return _find_year_files( base_path + site + '/', year_names, catalog,
+            'eddyproc', None, variant )
 
-    # Initialize DataFrame
-    site_df = pd.DataFrame()
-    # Loop through each year and fill the dataframe
-    for j in range(startyear, endyear + 1):
-        fName = fName_base + '_{0}.txt'.format( j )
-        # If theres is a file for that year, load it
-        if fName in file_list2:
-            # Call load_eddyproc_unc
-            year_df = load_eddyproc_output( base_path + site + '/' + fName, j )
-            # And append to site_df
-            site_df = site_df.append( year_df, verify_integrity=True  )
-        else:
-            print( 'WARNING: ' + fName + ' is missing')
 
-    # Now standardize the time period and index of site_df
-    idxyrs = site_df.index.year > startyear - 1;
-    site_df = site_df.iloc[ idxyrs, : ]
-    site_df = site_df.reindex( newidx )
+class IncrementalMultiyr( object ) :
+    """
+    Multi-year loading that re-parses only the years whose files changed.
+    The assembled multi-year DataFrame is kept along with a fingerprint
+    (path, mtime, size) of each year's file and the rows of the frame that
+    came from each file. Each call to load() checks the fingerprints and
+    reloads only new, changed or removed years, splicing them in with the
+    stored rows of the other files (files are not split on calendar years,
+    since some loaders, e.g. load_soilmet_qc, keep a file's own first and
+    last timestamps). If state_file is given, the frame, fingerprints and
+    rows are saved there (see cache_nmeg.save_frame) so they carry over
+    between runs.
 
-    return site_df
+    Args:
+        kind        : 'aflx', 'fluxall', 'soilmet' or 'eddyproc'
+        site        : Site name (as for the matching get_multiyr_* function)
+        path        : Data path (as for the matching get_multiyr_* function)
+        startyear   : First year of data to include
+        endyear     : Last year of data to include
+        state_file  : optional .npz file to keep the state in between runs
+        kwargs      : other arguments of the matching get_multiyr_* function
+                      (gapfilled, old_dparse, ext, GL2010, columns, compact,
+                      cache, catalog)
+
+    Attributes:
+        site_df     : the assembled DataFrame (after load() is called)
+        refreshed   : list of years reloaded by the last call to load()
+    """
+
+    def __init__( self, kind, site, path, startyear=now.year - 1,
+            endyear=now.year - 1, state_file=None, **kwargs ) :
+        if kind not in ( 'aflx', 'fluxall', 'soilmet', 'eddyproc' ):
+            raise ValueError( 'Unknown kind of file: ' + str( kind ))
+        self.kind = kind
+        self.site = site
+        self.path = path
+        self.startyear = startyear
+        self.endyear = endyear
+        self.state_file = state_file
+        self.kwargs = kwargs
+        self.site_df = None
+        self.fingerprints = {}
+        self.year_rows = {}
+        self.refreshed = []
+        # Loading options that change the parsed data; the stored state is
+        # only reused if these match
+        self._signature = json.dumps([ kind, site, os.path.abspath( path ),
+            startyear, endyear, sorted(( k, v ) for k, v in kwargs.items()
+                if k not in ( 'cache', 'catalog' ))], default=str )
+        if state_file is not None and os.path.exists( state_file ):
+            meta = cache_nmeg.load_frame_meta( state_file )
+            if ( meta.get( 'signature' ) == self._signature and
+                    'year_rows' in meta ):
+                self.site_df = cache_nmeg.load_frame( state_file )
+                self.fingerprints = { int( j ) : tuple( fp ) for j, fp in
+                        meta[ 'fingerprints' ].items() }
+                self.year_rows = { int( j ) : runs for j, runs in
+                        meta[ 'year_rows' ].items() }
+
+    def load( self ) :
+        """
+        Bring the multi-year DataFrame up to date and return it
+        """
+        year_files, empty_yrs = self._year_files()
+        prints = {}
+        for j, fpath in year_files.items():
+            st = os.stat( fpath )
+            prints[ j ] = ( os.path.abspath( fpath ), st.st_mtime, st.st_size )
+
+        if self.site_df is None:
+            changed = sorted( prints )
+        else:
+            changed = sorted( j for j in prints
+                    if self.fingerprints.get( j ) != prints[ j ])
+        removed = sorted( j for j in self.fingerprints if j not in prints )
+        self.refreshed = sorted( changed + removed )
+        if self.site_df is not None and len( self.refreshed ) == 0:
+            print( 'No changed years for ' + self.site )
+            return self.site_df
+
+        # Reload changed years and reuse the stored rows of the others
+        year_frames = {}
+        for j, fpath in year_files.items():
+            if j in changed:
+                year_frames[ j ] = self._load_year( j, fpath )
+            else:
+                year_frames[ j ] = self.site_df.iloc[ _rows_from_runs(
+                    self.year_rows[ j ]), : ]
+
+        if self.kind == 'aflx':
+            newidx = _aflx_multiyr_index( self.startyear, self.endyear,
+                    empty_yrs )
+        else:
+            newidx = pd.date_range( str( self.startyear ) + '-01-01 00:30:00',
+                    str( self.endyear + 1 ) + '-01-01 00:00:00',
+                    freq = '30min')
+        self.site_df = assemble_multiyr( list( year_frames.values() ), newidx )
+        self.fingerprints = prints
+        # Rows of the assembled frame that came from each file
+        self.year_rows = {}
+        for j, df in year_frames.items():
+            pos = newidx.get_indexer( df.index )
+            self.year_rows[ j ] = _row_runs( pos[ pos >= 0 ])
+        print( 'Refreshed years for ' + self.site + ': ' +
+                ', '.join( str( j ) for j in self.refreshed ))
+
+        if self.state_file is not None:
+            cache_nmeg.save_frame( self.state_file, self.site_df,
+                    signature=self._signature,
+                    fingerprints={ str( j ) : fp for j, fp in prints.items() },
+                    year_rows={ str( j ) : runs for j, runs in
+                        self.year_rows.items() })
+
+        return self.site_df
+
+    def _year_files( self ) :
+        # Find the year files as the matching get_multiyr_* function does
+        kw = self.kwargs
+        args = ( self.startyear, self.endyear, kw.get( 'catalog' ))
+        if self.kind == 'aflx':
+            return _aflx_year_files( self.site, self.path, self.startyear,
+                    self.endyear, kw.get( 'gapfilled', True ),
+                    kw.get( 'catalog' ))
+        elif self.kind == 'fluxall':
+            return _fluxall_year_files( self.site, self.path, *args )
+        elif self.kind == 'soilmet':
+            return _soilmet_year_files( self.site, self.path,
+                    kw.get( 'ext', 'qc' ), *args )
+        else:
+            return _eddyproc_year_files( self.site, self.path,
+                    kw.get( 'GL2010', False ), *args )
+
+    def _load_year( self, year, fpath ) :
+        # Parse one year as the matching get_multiyr_* function does
+        kw = self.kwargs
+        load_kw = dict( cache=kw.get( 'cache' ),
+                columns=kw.get( 'columns' ), compact=kw.get( 'compact', False ))
+        if self.kind == 'aflx':
+            return _cached_load( load_aflx_file, fpath, year=year,
+                    old_date_parse=kw.get( 'old_dparse' ), **load_kw )
+        elif self.kind == 'fluxall':
+            return _cached_load( load_fluxall_file, fpath, year=year,
+                    **load_kw )
+        elif self.kind == 'soilmet':
+            return _cached_load( load_soilmet_qc, fpath, **load_kw )
+        else:
+            return _cached_load( load_eddyproc_output, fpath, year=year,
+                    **load_kw )
+
+
+def _row_runs( pos ) :
+    # Row positions as a (json-friendly) list of [start, stop) runs
+    pos = np.unique( pos )
+    if len( pos ) == 0:
+        return []
+    breaks = np.flatnonzero( np.diff( pos ) != 1 ) + 1
+    starts = pos[ np.r_[ 0, breaks ]]
+    stops = pos[ np.r_[ breaks - 1, len( pos ) - 1 ]] + 1
+    return [[ int( a ), int( b )] for a, b in zip( starts, stops )]
+
+
+def _rows_from_runs( runs ) :
+    # Row positions from a list of [start, stop) runs (see _row_runs)
+    if len( runs ) == 0:
+        return np.array([], dtype=np.int64 )
+    return np.concatenate([ np.arange( a, b ) for a, b in runs ])
@@ -0,0 +1,161 @@
+"""
+Local read-through mirror of NMEG data on slow (e.g. sftp mounted) trees
+
+ mirror_nmeg.py
+ Greg Maurer
+"""
+
+import concurrent.futures as cf
+import os
+import shutil
+import threading
+
+
+class Mirror(object):
+    """
+    A local copy of files under a slow remote directory tree. Loaders ask
+    for local_path( remote_file ) and read the returned local file. A file
+    is copied (in large sequential blocks) the first time it is asked for,
+    or if the remote file's size or mtime no longer match the local copy.
+    prefetch() copies files in background threads so that the next files
+    can be transferred while the current one is parsed. Paths that are not
+    under remote_root are returned unchanged.
+
+    Args:
+        remote_root (str)   : root of the remote tree (e.g. the sftp mount)
+        local_root (str)    : directory to hold local copies (created if
+                              needed)
+        blocksize (int)     : bytes read from the remote file at a time
+        workers (int)       : number of background prefetch threads
+    """
+
+    def __init__( self, remote_root, local_root, blocksize=16*1024**2,
+            workers=2 ) :
+        self.remote_root = os.path.normpath( os.path.abspath( remote_root ))
+        self.local_root = local_root
+        self.blocksize = blocksize
+        self._pool = cf.ThreadPoolExecutor( max_workers=workers )
+        self._pending = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir( local_root ):
+            os.makedirs( local_root )
+
+    def __enter__( self ) :
+        return self
+
+    def __exit__( self, *exc ) :
+        self.close()
+
+    def close( self ) :
+        """ Wait for running prefetches and stop the background threads """
+        self._pool.shutdown( wait=True )
+
+    def mirrored( self, path ) :
+        """
+        Return the local path that mirrors a remote path, or None if path
+        is not under remote_root
+        """
+        rel = os.path.relpath( os.path.abspath( path ), self.remote_root )
+        if rel == os.pardir or rel.startswith( os.pardir + os.sep ):
+            return None
+        return os.path.join( self.local_root, rel )
+
+    def is_fresh( self, path ) :
+        """
+        True if the local copy of path exists and has the size and mtime of
+        the remote file
+        """
+        local = self.mirrored( path )
+        if local is None:
+            return True
+        try:
+            lst = os.stat( local )
+        except OSError:
+            return False
+        rst = os.stat( path )
+        return ( lst.st_size == rst.st_size and
+                int( lst.st_mtime ) == int( rst.st_mtime ))
+
+    def local_path( self, path ) :
+        """
+        Return the path of an up to date local copy of a remote file,
+        copying it first if needed (or waiting for a prefetch of it to
+        finish)
+
+        Args:
+            path (str)  : path of the file under remote_root
+
+        Return:
+            local (str) : path of the local copy
+        """
+        local = self.mirrored( path )
+        if local is None:
+            return path
+        with self._lock:
+            fut = self._pending.get( local )
+        if fut is not None:
+            fut.result()
+        if not self.is_fresh( path ):
+            self._copy( path, local )
+        return local
+
+    def prefetch( self, paths ) :
+        """
+        Start copying files in the background (files that are already
+        fresh or being copied are skipped). Returns a list of futures.
+        """
+        futures = []
+        for path in paths:
+            local = self.mirrored( path )
+            if local is None:
+                continue
+            with self._lock:
+                fut = self._pending.get( local )
+                if fut is None or fut.done():
+                    fut = self._pool.submit( self._fetch, path, local )
+                    self._pending[ local ] = fut
+            futures.append( fut )
+        return futures
+
+    def _fetch( self, path, local ) :
+        # Background copy of one file (if needed)
+        try:
+            if not self.is_fresh( path ):
+                self._copy( path, local )
+        finally:
+            with self._lock:
+                self._pending.pop( local, None )
+
+    def _copy( self, path, local ) :
+        # Copy to a temporary name in large blocks, give the copy the remote
+        # file's times, then move it into place
+        ldir = os.path.dirname( local )
+        if not os.path.isdir( ldir ):
+            os.makedirs( ldir, exist_ok=True )
+        tmp = local + '.{0}.{1}.part'.format( os.getpid(),
+                threading.get_ident() )
+        with self._open_remote( path ) as fin, open( tmp, 'wb' ) as fout:
+            shutil.copyfileobj( fin, fout, self.blocksize )
+            rst = os.fstat( fin.fileno() )
+        os.utime( tmp, ns=( rst.st_atime_ns, rst.st_mtime_ns ))
+        os.replace( tmp, local )
+
+    def _open_remote( self, path ) :
+        # Open a remote file for copying (subclasses can wrap the reads)
+        return open( path, 'rb' )
+
+
+def iter_local( paths, mirror=None, ahead=1 ) :
+    """
+    Yield ( key, local path ) for each ( key, remote path ) in a dict of
+    paths (e.g. the year files of a get_multiyr_* loader). While one file is
+    being used, the next ahead files are prefetched in the background.
+    Without a mirror the paths are yielded unchanged.
+    """
+    items = list( paths.items() )
+    for i, ( key, path ) in enumerate( items ):
+        if mirror is None:
+            yield key, path
+            continue
+        mirror.prefetch([ p for k, p in items[ i + 1:i + 1 + ahead ]])
+        yield key, mirror.local_path( path )
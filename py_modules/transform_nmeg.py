@@ -9,7 +9,8 @@ import pdb as pdb
 import datetime as dt
 import pandas as pd
 import numpy as np
-import math
+import re
+import warnings
 
 
 now = dt.datetime.now()
@@ -55,6 +56,49 @@ def sum_30min_et( df, t_air ) :
     return df_int[ export_cname ]
 
 
+def carbon_balance( df, pairs, nee_col='FC_F', nee=None, suffix='_ecb' ) :
+    """
+    Ensure ecosystem carbon balance (ECB) for one or more partitioning
+    methods. For each ( GPP, RECO ) column pair, GPP is recalculated as
+    RECO - NEE, negative values are set to zero, and the deficit is added
+    to RECO (so GPP_ecb - RECO_ecb = -NEE). All pairs are balanced
+    together as (time, method) arrays.
+
+    Args:
+        df (obj)        : pandas DataFrame with the partitioned fluxes (e.g.
+                          from load_nmeg.get_multiyr_eddyproc)
+        pairs (list)    : list of ( GPP column, RECO column ) tuples (e.g.
+                          [( 'GPP_f', 'Reco' )])
+        nee_col (str)   : NEE column in df
+        nee (obj)       : optional NEE Series from another dataframe (it
+                          is aligned to the index of df), used instead of
+                          nee_col
+        suffix (str)    : suffix for the balanced column names
+
+    Return:
+        ecb_df (obj)    : pandas DataFrame with <GPP>_ecb and <RECO>_ecb
+                          columns for each pair
+    """
+    if nee is None:
+        nee_vals = _col_values( df, nee_col )
+    else:
+        nee_vals = nee.reindex( df.index ).to_numpy( dtype=np.float64,
+                na_value=np.nan )
+    reco = _stack([ _col_values( df, r ) for g, r in pairs ], len( df.index ))
+    diff = reco - nee_vals[ :, None ]
+    neg = diff < 0
+    # GPP (raw GPP contains negative values) and RECO with the deficit
+    gpp_ecb = np.where( neg, 0.0, diff )
+    reco_ecb = np.where( neg, reco - diff, reco )
+    cols = []
+    for g, r in pairs:
+        cols.extend([ g + suffix, r + suffix ])
+    # Interleave so each GPP column is followed by its RECO column
+    vals = np.stack([ gpp_ecb, reco_ecb ], axis=2 ).reshape(
+            len( df.index ), 2 * len( pairs ))
+    return pd.DataFrame( vals, index=df.index, columns=cols, copy=False )
+
+
 def get_daytime_et_pet( df, freq='1D',
         le_col='LE_F', tair_col='TA_F', sw_col='SW_IN_F', h_col='H_F'):
     """
@@ -84,14 +128,30 @@ def get_daytime_et_pet( df, freq='1D',
     # Make a column to indicate daytime periods
     df_le['daytime_obs'] = 0
     # Mark daytime observations and nightime LE/Tair to NaN
-    daytest = df['SW_IN_F'] > 5
+    daytest = df[ sw_col ] > 5
     df_le.loc[daytest, 'daytime_obs'] = 1
     df_le.loc[~daytest, [le_col,tair_col]] = np.nan
 
     # Calculate mean daily LE and Tair
     df_le_daily = df_le.resample( freq ).mean()
     # Sum the number of daytime observations
-    df_le_daily['daytime_obs'] = df_le.daytime_obs.resample( freq).sum()
+    daytime_obs = df_le.daytime_obs.resample( freq).sum()
+
+    return _et_pet_frame( df_le_daily.index, df_le_daily[ le_col ].values,
+            df_le_daily[ tair_col ].values, df_le_daily[ h_col ].values,
+            daytime_obs.values, le_col, tair_col, h_col )
+
+
+def _et_pet_frame( idx, le_mean, tair_mean, h_mean, daytime_obs, le_col,
+        tair_col, h_col ) :
+    """
+    Calculate daytime ET and PET from mean daytime LE and air temperature,
+    mean H, and the number of daytime observations in each period (see
+    get_daytime_et_pet). Returns the get_daytime_et_pet DataFrame.
+    """
+    df_le_daily = pd.DataFrame({ le_col : le_mean, tair_col : tair_mean,
+        h_col : h_mean }, index=idx, columns=[ le_col, tair_col, h_col ])
+    df_le_daily['daytime_obs'] = np.asarray( daytime_obs ).astype( np.int64 )
     # Calculate the lambda value for each day
     df_le_daily['lmbda'] = ( 2.501 - 0.00236 * df_le_daily[tair_col] ) * 1000
     # Calculate ET ( mean daily LE / (1000*lambda) * # daytime seconds
@@ -122,6 +182,67 @@ def get_daytime_et_pet( df, freq='1D',
     return df_le_daily
 
 
+def _col_values( df, cname ) :
+    # Column values as a float64 array (NaN for missing values)
+    return df[ cname ].to_numpy( dtype=np.float64, na_value=np.nan )
+
+
+def _stack( cols, nrows ) :
+    # Stack 1-d column arrays into an (nrows, ncols) array
+    if len( cols ) == 0:
+        return np.empty(( nrows, 0 ))
+    return np.column_stack( cols )
+
+
+def _resample_bins( index, freq ) :
+    """
+    Find the bins that resampling a (sorted) timeseries index to freq
+    puts each observation in. Returns the new index (bin labels, as from
+    pandas resample), the position of the first observation in each bin,
+    and the number of observations in each bin.
+    """
+    sizes = pd.Series( np.zeros( len( index )), index=index ).resample(
+            freq ).size()
+    counts = sizes.values.astype( np.int64 )
+    starts = np.cumsum( counts ) - counts
+    return sizes.index, starts, counts
+
+
+def _reduce_bins( vals, starts, counts, how ) :
+    """
+    Reduce the rows of an (nobs, ncols) array within each bin (see
+    _resample_bins), skipping NaNs like pandas resample does. how is
+    'sum' (all-NaN and empty bins sum to 0), 'count' (of non-NaN values),
+    'mean', 'min' or 'max' (all-NaN and empty bins are NaN).
+    """
+    nbins = len( counts )
+    out = np.full(( nbins, vals.shape[ 1 ]),
+            0.0 if how in ( 'sum', 'count' ) else np.nan )
+    full = counts > 0
+    if vals.shape[ 1 ] == 0 or not full.any():
+        return out
+    # reduceat can't produce empty bins, so only reduce the full ones
+    idx = starts[ full ]
+    isnan = np.isnan( vals )
+    if how == 'count':
+        out[ full ] = np.add.reduceat( ~isnan, idx, axis=0 )
+    elif how in ( 'sum', 'mean' ):
+        tot = np.add.reduceat( np.where( isnan, 0.0, vals ), idx, axis=0 )
+        if how == 'sum':
+            out[ full ] = tot
+        else:
+            nobs = np.add.reduceat( ~isnan, idx, axis=0 )
+            with np.errstate( invalid='ignore', divide='ignore' ):
+                out[ full ] = np.where( nobs > 0, tot / nobs, np.nan )
+    elif how == 'min':
+        out[ full ] = np.fmin.reduceat( vals, idx, axis=0 )
+    elif how == 'max':
+        out[ full ] = np.fmax.reduceat( vals, idx, axis=0 )
+    else:
+        raise ValueError( 'Unknown reduction: ' + str( how ))
+    return out
+
+
 def resample_30min_aflx( df, freq='1D', c_fluxes=[ 'GPP', 'RECO', 'FC_F' ], 
         le_flux=[ 'LE_F' ], avg_cols=[ 'TA_F', 'RH_F', 'SW_IN_F', 'RNET_F' ],
         minmax_cols=[ 'TA_F', 'VPD_F' ], int_cols=['LE_F', 'H_F'],
@@ -131,6 +252,8 @@ def resample_30min_aflx( df, freq='1D', c_fluxes=[ 'GPP', 'RECO', 'FC_F' ],
     fluxes are converted from molar to mass flux and summed. Latent heat    
     flux is converted to ET and summed. A variable number for other met and 
     radiation values can be converted to averages, sums, or min/max outputs.
+    The resampling bins are found once and each statistic is computed for
+    all of its columns at once (see _resample_bins and _reduce_bins).
 
     Args:
         df          : pandas DataFrame object (usually derived from AF file)
@@ -147,68 +270,390 @@ def resample_30min_aflx( df, freq='1D', c_fluxes=[ 'GPP', 'RECO', 'FC_F' ],
     Return:
         df_resamp   : pandas dataframe with AF data at new frequency
     """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
 
-    # Calculate integrated c fluxes
-    c_flux_sums = sum_30min_c_flux( df[ c_fluxes ] )
-    # Calculate integrated ET
-    try: # Sometimes only C fluxes are provided, handle exceptions
-        et_flux_sum = sum_30min_et( df[ le_flux ], df[ tair_col ] )
-    except:
-        et_flux_sum = pd.DataFrame(index=df.index)
+    le_flux = _check_resample_cols( df, c_fluxes, le_flux, avg_cols,
+            minmax_cols, int_cols, sum_cols, tair_col )
+    sum_names, sum_vals, sum_scale = _sum_inputs( df, c_fluxes, le_flux,
+            int_cols, sum_cols, tair_col )
 
+    # Find the bins once and reduce every column in one pass per statistic
+    new_idx, starts, counts = _resample_bins( df.index, freq )
+    sums = _reduce_bins( _stack( sum_vals, len( df.index )), starts, counts,
+            'sum' ) * sum_scale
+    avgs = _reduce_bins( _stack([ _col_values( df, c ) for c in avg_cols ],
+        len( df.index )), starts, counts, 'mean' )
+    minmax_vals = _stack([ _col_values( df, c ) for c in minmax_cols ],
+            len( df.index ))
+    mins = _reduce_bins( minmax_vals, starts, counts, 'min' )
+    maxs = _reduce_bins( minmax_vals, starts, counts, 'max' )
 
-    # Subset site data into summable, averagable, etc data
-    df_sum = pd.concat( [ c_flux_sums, et_flux_sum, df[ sum_cols ]], 
-                          axis=1 );
-    df_int = df[ int_cols ]*1800
-    df_avg = df[ avg_cols ]
-    df_min = df[ minmax_cols ]
-    df_max = df[ minmax_cols ]
-    
-    # Resample to daily using sum or mean
-    sums_resamp = df_sum.resample( freq ).sum()
-    # Sometimes only C fluxes are provided, handle exceptions
-    try: 
-        int_resamp = df_int.resample( freq ).sum()
-        avg_resamp = df_avg.resample( freq ).mean()
-        min_resamp = df_min.resample( freq ).min()
-        max_resamp = df_max.resample( freq ).max()
-    
-        # Rename the int columns
-        for i in int_cols:
-            int_resamp.rename(columns={ i:i + '_int'}, inplace=True)
+    return _resampled_frame( new_idx, sum_names, len( int_cols ), sums,
+            avg_cols, avgs, minmax_cols, mins, maxs )
 
-        # Rename the avg columns
-        for i in avg_cols:
-            avg_resamp.rename(columns={ i:i + '_avg'}, inplace=True)
-        
-        # Rename the min/max columns
-        for i in minmax_cols:
-            min_resamp.rename(columns={ i:i + '_min'}, inplace=True)
-            max_resamp.rename(columns={ i:i + '_max'}, inplace=True)
-    except:
-        int_resamp = pd.DataFrame(index=sums_resamp.index)
-        avg_resamp = pd.DataFrame(index=sums_resamp.index)
-        min_resamp = pd.DataFrame(index=sums_resamp.index)
-        max_resamp = pd.DataFrame(index=sums_resamp.index)
 
-    # Rename the sum columns
-    for i in sum_cols:
-        sums_resamp.rename(columns={ i:i + '_sum'}, inplace=True)
+def _check_resample_cols( df, c_fluxes, le_flux, avg_cols, minmax_cols,
+        int_cols, sum_cols, tair_col ) :
+    """
+    Check for columns that resample_30min_aflx needs and return le_flux.
+    ET is only summed if the LE and air temperature columns are present
+    (sometimes only C fluxes are given), so le_flux is returned empty if
+    they are missing. Other missing columns raise a KeyError.
+    """
+    missing = [ c for c in ( list( c_fluxes ) + list( sum_cols ) +
+        list( int_cols ) + list( avg_cols ) + list( minmax_cols ))
+        if c not in df.columns ]
+    if len( missing ) > 0:
+        raise KeyError( 'Columns not in data frame: ' + ', '.join( missing ))
+    et_missing = [ c for c in list( le_flux ) + [ tair_col ]
+            if c not in df.columns ]
+    if len( le_flux ) > 0 and len( et_missing ) > 0:
+        print( 'WARNING: ET not summed, missing ' +
+                ', '.join( str( c ) for c in et_missing ))
+        return []
+    elif len( et_missing ) > 0:
+        return []
+    return list( le_flux )
+
 
+def _sum_inputs( df, c_fluxes, le_flux, int_cols, sum_cols, tair_col ) :
+    """
+    Return the output names, 30 minute values and unit conversion factors
+    of the summed columns of resample_30min_aflx (C fluxes, ET, sums and
+    integrals, in that order). ET is converted before summing because
+    lambda depends on air temperature; the other conversions are applied
+    to the sums.
+    """
+    c_fac = ( 12.011/1e+06 ) * 1800
+    sum_names = ( [ c + '_g_int' for c in c_fluxes ] +
+            [ 'ET_mm_24hint_' + str( i ) for i in range( len( le_flux ))] +
+            [ c + '_sum' for c in sum_cols ] +
+            [ c + '_int' for c in int_cols ])
+    sum_vals = [ _col_values( df, c ) for c in c_fluxes ]
+    if len( le_flux ) > 0:
+        lmbda = ( 2.501 - 0.00236 * _col_values( df, tair_col )) * 1000
+        sum_vals += [ ( 1 / ( lmbda * 1000 )) * _col_values( df, c ) * 1800
+                for c in le_flux ]
+    sum_vals += [ _col_values( df, c ) for c in list( sum_cols ) +
+            list( int_cols )]
+    sum_scale = np.array( [ c_fac ] * len( c_fluxes ) +
+            [ 1.0 ] * ( len( le_flux ) + len( sum_cols )) +
+            [ 1800.0 ] * len( int_cols ))
+    return sum_names, sum_vals, sum_scale
 
-    # Put to dataframes back together
-    df_resamp = pd.concat( [ sums_resamp, avg_resamp, int_resamp,
-        min_resamp, max_resamp ], axis=1 )
 
-    return df_resamp
+def _resampled_frame( new_idx, sum_names, nint, sums, avg_cols, avgs,
+        minmax_cols, mins, maxs ) :
+    """
+    Put resampled statistics together in the column order of
+    resample_30min_aflx (sums, avg, int, min, max). The last nint sums are
+    the integrals.
+    """
+    nsum = len( sum_names ) - nint
+    return pd.DataFrame( np.hstack([ sums[ :, :nsum ], avgs,
+        sums[ :, nsum: ], mins, maxs ]), index=new_idx,
+        columns=( sum_names[ :nsum ] + [ c + '_avg' for c in avg_cols ] +
+            sum_names[ nsum: ] + [ c + '_min' for c in minmax_cols ] +
+            [ c + '_max' for c in minmax_cols ]))
+
+
+class DailyRollup( object ) :
+    """
+    Daily partial statistics of 30 minute flux data, from which
+    resample_30min_aflx and get_daytime_et_pet results at daily or longer
+    frequencies (weekly, monthly, annual, water year) are derived. The 30
+    minute data is only read once, when the rollup is created; each day's
+    sums, counts, minima and maxima (and the daytime sums for ET/PET) are
+    kept, and longer periods are made by merging days.
+
+    Args:
+        df          : pandas DataFrame object (usually derived from AF file)
+        c_fluxes, le_flux, avg_cols, minmax_cols, int_cols, sum_cols,
+        tair_col    : columns as for resample_30min_aflx
+        le_col, sw_col, h_col : columns as for get_daytime_et_pet (set
+                      le_col=None to skip daytime ET/PET)
+        wy_ndays    : days to offset water years by (see add_WY_cols)
+
+    Attributes:
+        index       : daily DatetimeIndex of the partials
+    """
+
+    def __init__( self, df, c_fluxes=[ 'GPP', 'RECO', 'FC_F' ],
+            le_flux=[ 'LE_F' ], avg_cols=[ 'TA_F', 'RH_F', 'SW_IN_F',
+                'RNET_F' ], minmax_cols=[ 'TA_F', 'VPD_F' ],
+            int_cols=['LE_F', 'H_F'], sum_cols=[ 'P_F' ], tair_col='TA_F',
+            le_col='LE_F', sw_col='SW_IN_F', h_col='H_F', wy_ndays=92 ) :
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+        self.avg_cols = list( avg_cols )
+        self.minmax_cols = list( minmax_cols )
+        self.nint = len( int_cols )
+        self.tair_col = tair_col
+        self.le_col = le_col
+        self.h_col = h_col
+        self.wy_ndays = wy_ndays
+        le_flux = _check_resample_cols( df, c_fluxes, le_flux, avg_cols,
+                minmax_cols, int_cols, sum_cols, tair_col )
+        self.sum_names, sum_vals, self.sum_scale = _sum_inputs( df,
+                c_fluxes, le_flux, int_cols, sum_cols, tair_col )
+
+        # Daytime LE and air temperature (night values are NaN), all H, and
+        # a 1/0 daytime flag, for the daytime ET/PET means
+        if le_col is not None:
+            daytest = _col_values( df, sw_col ) > 5
+            day_vals = [ np.where( daytest, _col_values( df, le_col ), np.nan ),
+                    np.where( daytest, _col_values( df, tair_col ), np.nan ),
+                    _col_values( df, h_col ), daytest.astype( np.float64 )]
+        else:
+            day_vals = []
+
+        nobs = len( df.index )
+        self.index, starts, counts = _resample_bins( df.index, '1D' )
+        self._sums = _reduce_bins( _stack( sum_vals, nobs ), starts, counts,
+                'sum' )
+        mean_vals = _stack([ _col_values( df, c ) for c in avg_cols ] +
+                day_vals, nobs )
+        self._mean_sums = _reduce_bins( mean_vals, starts, counts, 'sum' )
+        self._mean_counts = _reduce_bins( mean_vals, starts, counts, 'count' )
+        minmax_vals = _stack([ _col_values( df, c ) for c in minmax_cols ],
+                nobs )
+        self._mins = _reduce_bins( minmax_vals, starts, counts, 'min' )
+        self._maxs = _reduce_bins( minmax_vals, starts, counts, 'max' )
+
+    def _bins( self, freq ) :
+        # Bins of days for a frequency (freq='WY' groups by water year)
+        if freq == 'WY':
+            wy = ( self.index + dt.timedelta( self.wy_ndays )).year
+            years, starts, counts = np.unique( wy, return_index=True,
+                    return_counts=True )
+            return pd.Index( years, name='year_w' ), starts, counts
+        new_idx, starts, counts = _resample_bins( self.index, freq )
+        if len( new_idx ) > 1 and ( new_idx[ 1 ] - new_idx[ 0 ] <
+                pd.Timedelta( '1D' )):
+            raise ValueError( 'Rollups can not be shorter than one day' )
+        return new_idx, starts, counts
+
+    def _merge( self, freq ) :
+        # Merge daily partials into freq bins (sums, mean sums and counts,
+        # mins and maxes)
+        new_idx, starts, counts = self._bins( freq )
+        return ( new_idx,
+                _reduce_bins( self._sums, starts, counts, 'sum' ),
+                _reduce_bins( self._mean_sums, starts, counts, 'sum' ),
+                _reduce_bins( self._mean_counts, starts, counts, 'sum' ),
+                _reduce_bins( self._mins, starts, counts, 'min' ),
+                _reduce_bins( self._maxs, starts, counts, 'max' ))
+
+    def resample( self, freq='1D' ) :
+        """
+        Return the resample_30min_aflx result at freq (e.g. '1D', 'W',
+        'ME', 'YE' or 'WY' for water years)
+        """
+        new_idx, sums, msums, mcounts, mins, maxs = self._merge( freq )
+        navg = len( self.avg_cols )
+        with np.errstate( invalid='ignore', divide='ignore' ):
+            avgs = msums[ :, :navg ] / mcounts[ :, :navg ]
+        return _resampled_frame( new_idx, self.sum_names, self.nint,
+                sums * self.sum_scale, self.avg_cols, avgs, self.minmax_cols,
+                mins, maxs )
+
+    def daytime_et_pet( self, freq='1D' ) :
+        """
+        Return the get_daytime_et_pet result at freq (e.g. '1D', 'W',
+        'ME', 'YE' or 'WY' for water years)
+        """
+        if self.le_col is None:
+            raise ValueError( 'Rollup was made without daytime ET/PET' )
+        new_idx, sums, msums, mcounts, mins, maxs = self._merge( freq )
+        navg = len( self.avg_cols )
+        with np.errstate( invalid='ignore', divide='ignore' ):
+            means = msums[ :, navg:navg + 3 ] / mcounts[ :, navg:navg + 3 ]
+        return _et_pet_frame( new_idx, means[ :, 0 ], means[ :, 1 ],
+                means[ :, 2 ], msums[ :, navg + 3 ], self.le_col,
+                self.tair_col, self.h_col )
+
+
+def daily_peaks( df, max_cols=[ 'GPP' ], min_cols=[ 'FC_F', 'RECO' ],
+        freq='30min' ) :
+    """
+    Find the daily peak (maximum or minimum) of flux columns and the time
+    of day it occurs. The data is placed on a regular (day, time slot)
+    grid, so all days and columns are searched at once. Days are calendar
+    days of the timestamps (so an AF 00:00 timestamp is the first slot of
+    its day). If a peak value occurs more than once in a day the first one
+    is used. Days with no valid data have NaN peaks.
+
+    Args:
+        df          : pandas DataFrame object (usually derived from AF file)
+        max_cols    : list of columns to find the daily maximum of
+        min_cols    : list of columns to find the daily minimum of (e.g.
+                      FC_F, where uptake is negative)
+        freq        : frequency of the data (slots per day = 1 day / freq)
+
+    Return:
+        peaks       : pandas DataFrame with a daily index and <col>_peak
+                      (value), <col>_peak_slot (slot of the day) and
+                      <col>_peak_dayfrac (slot time as a fraction of the
+                      day) columns for each column
+    """
+    both = set( max_cols ) & set( min_cols )
+    if both:
+        raise ValueError( 'Columns in both max_cols and min_cols: ' +
+                ', '.join( sorted( both )))
+    step = pd.Timedelta( freq )
+    nslots = int( pd.Timedelta( '1D' ) / step )
+    days = df.index.normalize()
+    offset = ( df.index - days ) / step
+    if not np.all( offset == np.floor( offset )):
+        raise ValueError( 'Timestamps are not on regular ' + str( freq ) +
+                ' slots' )
+    day_idx = pd.date_range( days.min(), days.max(), freq='1D' )
+    pos = ( day_idx.get_indexer( days ) * nslots +
+            np.asarray( offset, dtype=np.int64 ))
+
+    cols = list( max_cols ) + list( min_cols )
+    peaks = pd.DataFrame( index=day_idx )
+    for i, cname in enumerate( cols ):
+        # (day, slot) grid of values, missing slots are NaN
+        grid = np.full( len( day_idx ) * nslots, np.nan )
+        grid[ pos ] = _col_values( df, cname )
+        grid = grid.reshape( len( day_idx ), nslots )
+        empty = np.isnan( grid ).all( axis=1 )
+        if i < len( max_cols ):
+            slot = np.argmax( np.where( np.isnan( grid ), -np.inf, grid ),
+                    axis=1 )
+        else:
+            slot = np.argmin( np.where( np.isnan( grid ), np.inf, grid ),
+                    axis=1 )
+        value = grid[ np.arange( len( day_idx )), slot ]
+        slot = np.where( empty, np.nan, slot )
+        peaks[ cname + '_peak' ] = np.where( empty, np.nan, value )
+        peaks[ cname + '_peak_slot' ] = slot
+        peaks[ cname + '_peak_dayfrac' ] = slot / nslots
+    return peaks
+
+
+class DerivedVars( object ) :
+    """
+    A list of named formulas that add derived columns (e.g. degree days
+    or GPP/RE) to a site dataframe, or to every frame in a dictionary of
+    site dataframes. Formulas are pandas.eval expressions of column names
+    and of earlier formulas, and are evaluated in the order they were
+    added. Each column and formula result is computed once per apply() and
+    reused by later formulas, and all sites are evaluated together (their
+    columns are concatenated), so each formula is one vectorized operation.
+
+    Formulas have a stage, 'before' or 'after' resampling, so one
+    DerivedVars can hold formulas for 30 minute data (e.g. hours of C
+    uptake, to be summed) and for the resampled data.
+
+    Example:
+        dv = DerivedVars()
+        dv.add( 'hrs_C_uptake', '0.5 * ( FC_F < 0 )', stage='before' )
+        dv.add( 'degree_days2', '( TA_F_max + TA_F_min ) / 2', lower=0 )
+        hourly = dv.apply( hourly, stage='before' )
+    """
+
+    _names = re.compile( r'[A-Za-z_][A-Za-z0-9_]*' )
+
+    def __init__( self ) :
+        self.formulas = []
+
+    def add( self, name, expr, lower=None, upper=None, where=None,
+            otherwise=np.nan, stage='after', keep=True ) :
+        """
+        Add a formula (returns the DerivedVars, so calls can be chained)
+
+        Args:
+            name (str)      : name of the new column
+            expr (str)      : expression (e.g. 'GPP_g_int / RECO_g_int')
+            lower, upper    : values to clamp the result to (NaN stays NaN)
+            where (str)     : optional condition expression; where it is
+                              false the result is set to otherwise
+            otherwise       : value used where the condition is false
+            stage (str)     : 'before' or 'after' resampling
+            keep (bool)     : if False the result is an intermediate that
+                              later formulas can use but is not added
+        """
+        if stage not in ( 'before', 'after' ):
+            raise ValueError( 'stage must be before or after: ' + str( stage ))
+        self.formulas.append( { 'name' : name, 'expr' : expr,
+            'lower' : lower, 'upper' : upper, 'where' : where,
+            'otherwise' : otherwise, 'stage' : stage, 'keep' : keep } )
+        return self
+
+    def apply( self, data, stage='after' ) :
+        """
+        Evaluate the formulas of one stage and add their results as columns
+
+        Args:
+            data        : pandas DataFrame, or a dictionary of DataFrames
+                          with site keys
+            stage (str) : 'before' or 'after' resampling
+
+        Return:
+            new DataFrame (or dictionary of DataFrames) with the derived
+            columns added (existing columns of the same name are replaced)
+        """
+        if stage not in ( 'before', 'after' ):
+            raise ValueError( 'stage must be before or after: ' + str( stage ))
+        single = isinstance( data, pd.DataFrame )
+        frames = { None : data } if single else data
+        keys = list( frames.keys() )
+        bounds = np.cumsum([ 0 ] + [ len( frames[ k ].index ) for k in keys ])
+
+        namespace = {}
+        def lookup( names ) :
+            # Values of the names in an expression that are columns (of any
+            # site, NaN where a site lacks it) or earlier results
+            local = {}
+            for n in names:
+                if n not in namespace and any( n in frames[ k ].columns
+                        for k in keys ):
+                    namespace[ n ] = np.concatenate([ _col_values(
+                        frames[ k ], n ) if n in frames[ k ].columns else
+                        np.full( len( frames[ k ].index ), np.nan )
+                        for k in keys ])
+                if n in namespace:
+                    local[ n ] = namespace[ n ]
+            return local
+
+        results = []
+        for f in self.formulas:
+            if f[ 'stage' ] != stage:
+                continue
+            exprs = [ f[ 'expr' ]] + ([ f[ 'where' ]] if f[ 'where' ] else [])
+            local = lookup( set( self._names.findall( ' '.join( exprs ))))
+            vals = np.array( np.broadcast_to( pd.eval( f[ 'expr' ],
+                local_dict=local ), ( bounds[ -1 ], )))
+            if f[ 'lower' ] is not None or f[ 'upper' ] is not None:
+                vals = np.clip( vals, f[ 'lower' ], f[ 'upper' ])
+            if f[ 'where' ]:
+                cond = np.asarray( pd.eval( f[ 'where' ], local_dict=local ),
+                        dtype=bool )
+                vals = np.where( cond, vals, f[ 'otherwise' ])
+            namespace[ f[ 'name' ]] = vals
+            if f[ 'keep' ]:
+                results.append( f[ 'name' ])
+
+        out = {}
+        for i, k in enumerate( keys ):
+            new_cols = { n : namespace[ n ][ bounds[ i ]:bounds[ i + 1 ]]
+                    for n in results }
+            out[ k ] = frames[ k ].assign( **new_cols )
+        if single:
+            return out[ None ]
+        return out
+
 
 def get_var_allsites( datadict, varname, sites, startyear=now.year - 1,
                       endyear=now.year - 1 ):
     """
     Take a dictionary of dataframes indexed by sitename, extract requested
     variable from each one, and place in column (named by site) in a new
-    dataframe.
+    dataframe. To get several variables use SitePanel, which aligns each
+    site only once.
 
     Args:
         datadict    : Dictionary of dataframes with site keys
@@ -221,21 +666,84 @@ def get_var_allsites( datadict, varname, sites, startyear=now.year - 1,
         new_df     : pandas DataFrame containing multiple years of data
                       from one site
     """
-    
-    # Create empty dataframe spanning startyear to endyear
-    # Will contain the multi-year column for each site at the correct frequency
-    frequency = datadict[sites[1]].index.freq
-    newidx = pd.date_range(str(startyear) + '-01-01',
-                           str(endyear + 1) + '-01-01', freq = frequency)
-    new_df = pd.DataFrame(index = newidx)
-    
-    # Loop through site names and extract variable
-    for i, site in enumerate(sites):
-        # Get the multi-year data for the site
-        site_df = datadict[ site ]
-        new_df[ site ] = site_df[ varname ]
+    panel = SitePanel( datadict, [ varname ], sites, startyear=startyear,
+            endyear=endyear )
+    return panel.frame( varname )
+
+
+class SitePanel( object ) :
+    """
+    Several variables from a dictionary of site dataframes, aligned to one
+    shared index. Each site's data is aligned once and copied into a dense
+    (variable, site, time) block. frame( varname ) returns a DataFrame
+    with a column for each site (like get_var_allsites) that is a view of
+    the block, not a copy. Variables missing at a site are NaN.
+
+    Args:
+        datadict    : Dictionary of dataframes with site keys (e.g. a
+                      load_nmeg.LazySiteCollection)
+        variables   : List of variable names
+        sites       : List of site names ( Ameriflux style )
+        startyear   : First year of data to include
+        endyear     : Last year of data to include
+        freq        : Frequency of the shared index (default is the
+                      frequency of the first site's data)
+
+    Attributes:
+        index       : the shared DatetimeIndex
+        block       : (variable, site, time) numpy array
+    """
+
+    def __init__( self, datadict, variables, sites, startyear=now.year - 1,
+            endyear=now.year - 1, freq=None ) :
+        self.variables = list( variables )
+        self.sites = list( sites )
+        if freq is None:
+            first_idx = datadict[ self.sites[ 0 ]].index
+            freq = first_idx.freq or pd.infer_freq( first_idx )
+        # Create the shared index spanning startyear to endyear
+        self.index = pd.date_range( str( startyear ) + '-01-01',
+                str( endyear + 1 ) + '-01-01', freq=freq )
+        self.block = np.full(( len( self.variables ), len( self.sites ),
+            len( self.index )), np.nan )
+
+        # Align each site once and copy all of its variables
+        for j, site in enumerate( self.sites ):
+            site_df = datadict[ site ]
+            pos = self.index.get_indexer( site_df.index )
+            inrange = pos >= 0
+            for i, varname in enumerate( self.variables ):
+                if varname not in site_df.columns:
+                    continue
+                vals = site_df[ varname ].to_numpy( dtype=np.float64,
+                        na_value=np.nan )
+                self.block[ i, j, pos[ inrange ]] = vals[ inrange ]
+
+    @property
+    def values( self ) :
+        """ The block as a (site, time, variable) view """
+        return self.block.transpose( 1, 2, 0 )
+
+    def frame( self, varname ) :
+        """
+        Return a variable as a DataFrame with a column for each site. The
+        frame shares memory with the block.
+        """
+        i = self.variables.index( varname )
+        return pd.DataFrame( self.block[ i ].T, index=self.index,
+                columns=self.sites, copy=False )
+
+    def __getitem__( self, varname ) :
+        return self.frame( varname )
+
+    def site_frame( self, site ) :
+        """
+        Return a DataFrame of all variables for one site
+        """
+        j = self.sites.index( site )
+        return pd.DataFrame( self.block[ :, j, : ].T, index=self.index,
+                columns=self.variables )
 
-    return new_df
 
 def add_WY_cols( df, ndays=92 ) :
     """
@@ -268,59 +776,269 @@ def var_climatology( ser ) :
     """
     Take multiyear series and return a climatology dataset in which
     each year is separated into a column, and annual mean, std dev, std err,
-    cv and other descriptive stats are calculated.
+    cv and other descriptive stats are calculated. Values are placed by
+    year and day of year (rows 1-366), or for sub-daily (e.g. 30 minute)
+    data by year, day of year and time of day. All years and statistics
+    are computed at once from a (year, day of year) array.
     
     Args:
-        ser (obj)   : a pandas series object with a timeseries index
+        ser (obj)   : a pandas series object with a timeseries index, or a
+                      DataFrame to get the climatology of every column
         
     Return:
-        clim (obj)  : a pandas dataframe with year and descriptive columns 
+        clim (obj)  : a pandas dataframe with year and descriptive columns.
+                      The index is day of year, or (doy, halfhour) for 30
+                      minute data ((doy, slot) for other sub-daily data).
+                      For DataFrame input the columns are a MultiIndex of
+                      (column, year or statistic).
+    """
+    years, raw_years, vals, nslots, rows = _year_doy_array( ser )
+
+    # Get summary stats each day of the year (or time of day)
+    with warnings.catch_warnings(), np.errstate( invalid='ignore',
+            divide='ignore' ):
+        warnings.simplefilter( 'ignore', category=RuntimeWarning )
+        allyr_mean = np.nanmean( raw_years, axis=0 )
+        allyr_stdev = np.nanstd( raw_years, axis=0, ddof=1 )
+        allyr_stderr = allyr_stdev / np.sqrt( len( years ) - 1 )
+        allyr_cv = allyr_stdev / allyr_mean
+        allyr_cv2 = allyr_stdev / np.nanmean( vals, axis=0 )
+
+    # Make the index (day of year, plus time of day slot if sub-daily)
+    if nslots == 1:
+        idx = pd.RangeIndex( 1, 367 )
+    else:
+        idx = pd.MultiIndex.from_product([ range( 1, 367 ), range( nslots )],
+                names=[ 'doy', 'halfhour' if nslots == 48 else 'slot' ])
+    columns = ([ str( y ) for y in years ] + [ 'allyr_mean', 'allyr_stdev',
+        'allyr_stderr', 'allyr_cv', 'allyr_cv2' ])
+    clims = [ pd.DataFrame( np.column_stack([ raw_years[ :, :, i ].T,
+        allyr_mean[ :, i ], allyr_stdev[ :, i ], allyr_stderr[ :, i ],
+        allyr_cv[ :, i ], allyr_cv2[ :, i ]]),
+        index=idx, columns=columns ) for i in range( vals.shape[ 1 ])]
+
+    if isinstance( ser, pd.DataFrame ):
+        return pd.concat( clims, axis=1, keys=list( ser.columns ))
+    return clims[ 0 ]
+
+
+def _year_doy_slots( index ) :
+    """
+    Return integer year codes, the row of each observation in a
+    (day of year, time of day) climatology, the years, and the number of
+    time of day slots per day (1 for daily or longer data). Years with
+    less than a day of observations (e.g. the final 00:00 timestamp of an
+    AF 30 minute series) are left out and their year code is -1.
     """
+    if len( index ) > 1:
+        step = np.median( np.diff( index.asi8 ))
+    else:
+        step = 86400e9
+    if step >= 86400e9:
+        nslots = 1
+    else:
+        nslots = int( round( 86400e9 / step ))
+    years, year_code, nobs = np.unique( index.year, return_inverse=True,
+            return_counts=True )
+    if nslots > 1 and np.any( nobs < nslots ):
+        keep = nobs >= nslots
+        new_code = np.where( keep, np.cumsum( keep ) - 1, -1 )
+        years = years[ keep ]
+        year_code = new_code[ year_code ]
+    rows = ( np.asarray( index.dayofyear ) - 1 ) * nslots
+    if nslots > 1:
+        nanosec = ( index.asi8 - index.normalize().asi8 )
+        rows = rows + ( nanosec // ( 86400e9 / nslots )).astype( np.int64 )
+    return year_code, rows, years, nslots
 
-    # Create dataframes to hold raw year data and climatology calculations
-    raw_years = pd.DataFrame( index = range( 1, 367 ))
-    clim = raw_years.copy()
-    # Put 1 day values for each year in a column
-    for i in np.unique(ser.index.year):
-        year_vals = ser[ ser.index.year==i ].values
-        raw_years[ str(i) ] = np.nan
-        raw_years[ str(i) ][ 0:len(year_vals)] = year_vals
-        clim[ str(i) ] = raw_years[ str(i) ]
-    # Get summary stats each day of the year
-    clim[ 'allyr_mean' ] = raw_years.mean(axis=1)
-    clim[ 'allyr_stdev' ] = raw_years.std(axis=1)
-    clim[ 'allyr_stderr' ] = clim.allyr_stdev / math.sqrt( 
-            len(np.unique(ser.index.year))-1 )
-    clim[ 'allyr_cv' ] = clim.allyr_stdev / clim.allyr_mean
-    clim[ 'allyr_cv2' ] = clim.allyr_stdev / ser.mean()
 
-    return clim
+def _year_doy_array( data ) :
+    """
+    Scatter a timeseries (Series or DataFrame) into a (year, day of year
+    [and time of day slot], column) array in one step. Returns the years,
+    the array, the (observation, column) values, the number of time of
+    day slots per day, and the climatology row of each observation.
+    """
+    year_code, rows, years, nslots = _year_doy_slots( data.index )
+    if isinstance( data, pd.DataFrame ):
+        vals = np.column_stack([ _col_values( data, c )
+            for c in data.columns ])
+    else:
+        vals = data.to_numpy( dtype=np.float64, na_value=np.nan )[ :, None ]
+    raw_years = np.full(( len( years ), 366 * nslots, vals.shape[ 1 ]),
+            np.nan )
+    inyear = year_code >= 0
+    raw_years[ year_code[ inyear ], rows[ inyear ]] = vals[ inyear ]
+    return years, raw_years, vals, nslots, rows
 
 
 def var_anomaly( ser, norm=False ) :
     """
     Take multiyear series and return an anomaly series of the distance
-    from the multiyear mean for each observation.
+    from the multiyear mean for each observation. Each observation is
+    matched to its day of year (or time of day for sub-daily data) in the
+    climatology (see var_climatology) by an integer row index.
     
     Args:
-        ser (obj)   : a pandas series object with a timeseries index
+        ser (obj)   : a pandas series object with a timeseries index, or a
+                      DataFrame to get anomalies of every column
         norm (bool) : if True, divide anomaly by mean to normalize
         
     Return:
-        anom (obj)  : a pandas dataframe with year and descriptive columns 
+        anom (obj)  : a pandas series (or dataframe) of anomalies
     """
 
     # Calculate the anomaly of the original series
     # (subtract multiyear mean)
-    anom = ser.copy()
-    serclim = var_climatology( ser )
-    for i in np.unique(ser.index.year):
+    years, raw_years, vals, nslots, rows = _year_doy_array( ser )
+    with warnings.catch_warnings(), np.errstate( invalid='ignore',
+            divide='ignore' ):
+        warnings.simplefilter( 'ignore', category=RuntimeWarning )
+        allyr_mean = np.nanmean( raw_years, axis=0 )[ rows ]
+        anom_vals = vals - allyr_mean
         if norm:
-            anom[ anom.index.year==i ] = ((ser[ ser.index.year==i ] -
-                serclim.allyr_mean[0:len(ser[ ser.index.year==i ])].values) / 
-                serclim.allyr_mean[0:len(ser[ ser.index.year==i ])].values)
-        else:
-            anom[ anom.index.year==i ] = (ser[ ser.index.year==i ] -
-                    serclim.allyr_mean[0:len(ser[ ser.index.year==i ])].values)
-            
-    return anom
+            anom_vals = anom_vals / allyr_mean
+
+    if isinstance( ser, pd.DataFrame ):
+        return pd.DataFrame( anom_vals, index=ser.index, columns=ser.columns )
+    return pd.Series( anom_vals[ :, 0 ], index=ser.index, name=ser.name )
+
+
+def monthly_cwdiff( precip, pet ) :
+    """
+    Calculate monthly climatic water difference (precipitation - PET) for
+    SPEI. Inputs can be daily or monthly totals, e.g. P_F_sum from
+    resample_30min_aflx and PET_mm_dayint from get_daytime_et_pet, or
+    PRISM precip and PET. Months with no data are NaN.
+
+    Args:
+        precip (obj)    : pandas Series (or DataFrame with site columns) of
+                          precipitation totals
+        pet (obj)       : pandas Series (or DataFrame) of PET totals
+
+    Return:
+        cwdiff (obj)    : monthly P - PET
+    """
+    return ( precip.resample( 'ME' ).sum( min_count=1 ) -
+            pet.resample( 'ME' ).sum( min_count=1 ))
+
+
+def spei( cwdiff, scales=range( 1, 25 ), min_years=4 ) :
+    """
+    Calculate the Standardized Precipitation-Evapotranspiration Index
+    (Vicente-Serrano et al. 2010) from monthly climatic water difference
+    for many accumulation scales and sites at once. For each scale, P-PET
+    is summed over the preceding months (including the current one), a
+    3 parameter log-logistic distribution is fit separately for each
+    calendar month with probability weighted moments, and the fitted
+    probabilities are converted to standard normal values.
+
+    Args:
+        cwdiff (obj)    : pandas Series (or DataFrame with site columns) of
+                          monthly P - PET (see monthly_cwdiff)
+        scales (list)   : accumulation scales in months
+        min_years (int) : minimum number of years to fit a calendar month
+
+    Return:
+        spei_df (obj)   : pandas DataFrame with an SPEI_monthly_<scale>
+                          column for each scale. For DataFrame input the
+                          columns are a MultiIndex of (site, SPEI column).
+    """
+    scales = list( scales )
+    if isinstance( cwdiff, pd.DataFrame ):
+        sites = list( cwdiff.columns )
+        vals = np.column_stack([ _col_values( cwdiff, c ) for c in sites ])
+    else:
+        sites = None
+        vals = cwdiff.to_numpy( dtype=np.float64, na_value=np.nan )[ :, None ]
+    ntime, nsite = vals.shape
+
+    # Running sums over each scale from cumulative sums. Sums including a
+    # missing month, or before a full window, are missing.
+    isnan = np.isnan( vals )
+    csum = np.vstack([ np.zeros(( 1, nsite )),
+        np.cumsum( np.where( isnan, 0.0, vals ), axis=0 )])
+    cnan = np.vstack([ np.zeros(( 1, nsite )), np.cumsum( isnan, axis=0 )])
+    acc = np.full(( len( scales ), ntime, nsite ), np.nan )
+    for i, k in enumerate( scales ):
+        window = csum[ k: ] - csum[ :-k ]
+        nmiss = cnan[ k: ] - cnan[ :-k ]
+        acc[ i, k - 1: ] = np.where( nmiss > 0, np.nan, window )
+
+    # Scatter into (scale, calendar month, year, site) and fit each
+    # calendar month of each scale and site at once
+    years, year_code = np.unique( cwdiff.index.year, return_inverse=True )
+    month_code = np.asarray( cwdiff.index.month ) - 1
+    acc_mon = np.full(( len( scales ), 12, len( years ), nsite ), np.nan )
+    acc_mon[ :, month_code, year_code, : ] = acc
+    alpha, beta, gamma = _fit_loglogistic( acc_mon, min_years )
+
+    # Fitted probabilities for each observation, then standard normal values
+    a = alpha[ :, month_code ]
+    b = beta[ :, month_code ]
+    g = gamma[ :, month_code ]
+    # (values outside the fitted range have probability 0 or 1)
+    with np.errstate( invalid='ignore', divide='ignore', over='ignore' ):
+        ratio = a / ( acc - g )
+        prob = np.where( ratio > 0, 1 / ( 1 + ratio ** b ),
+                np.where( b > 0, 0.0, 1.0 ))
+    prob[ np.isnan( acc ) | np.isnan( a ) ] = np.nan
+    spei_vals = _norm_quantile( prob )
+
+    cols = [ 'SPEI_monthly_' + str( k ) for k in scales ]
+    frames = [ pd.DataFrame( spei_vals[ :, :, j ].T, index=cwdiff.index,
+        columns=cols ) for j in range( nsite )]
+    if sites is None:
+        return frames[ 0 ]
+    return pd.concat( frames, axis=1, keys=sites )
+
+
+def _fit_loglogistic( x, min_n ) :
+    """
+    Fit 3 parameter log-logistic distributions to samples along axis 2
+    of an array (NaNs are ignored) using probability weighted moments
+    with plotting positions (i - 0.35)/N (Vicente-Serrano et al. 2010).
+    Returns arrays of the alpha (scale), beta (shape) and gamma (origin)
+    parameters, NaN where there are fewer than min_n values or the fit
+    fails.
+    """
+    xs = np.sort( x, axis=2 ) # NaNs sort to the end
+    n = np.sum( ~np.isnan( xs ), axis=2, keepdims=True )
+    rank = np.arange( 1, xs.shape[ 2 ] + 1 ).reshape( 1, 1, -1, 1 )
+    with np.errstate( invalid='ignore', divide='ignore', over='ignore' ):
+        one_minus_f = 1 - ( rank - 0.35 ) / n
+        xz = np.where( np.isnan( xs ), 0.0, xs )
+        w0 = np.sum( xz, axis=2 ) / n[ :, :, 0 ]
+        w1 = np.sum( one_minus_f * xz, axis=2 ) / n[ :, :, 0 ]
+        w2 = np.sum( one_minus_f ** 2 * xz, axis=2 ) / n[ :, :, 0 ]
+        beta = ( 2 * w1 - w0 ) / ( 6 * w1 - w0 - 6 * w2 )
+        # Gamma(1 + 1/beta) * Gamma(1 - 1/beta) = (pi/beta) / sin(pi/beta)
+        gfunc = ( np.pi / beta ) / np.sin( np.pi / beta )
+        alpha = ( w0 - 2 * w1 ) * beta / gfunc
+        gamma = w0 - alpha * gfunc
+    # (left skewed samples give beta < -1 and an upper bound, gamma)
+    bad = ( n[ :, :, 0 ] < min_n ) | ~( np.abs( beta ) > 1 ) | ~np.isfinite(
+            alpha )
+    for p in ( alpha, beta, gamma ):
+        p[ bad ] = np.nan
+    return alpha, beta, gamma
+
+
+def _norm_quantile( prob ) :
+    """
+    Standard normal quantiles of non-exceedance probabilities, using the
+    Abramowitz and Stegun (1965, 26.2.23) approximation. Probabilities of
+    0 or 1 give NaN.
+    """
+    c0, c1, c2 = 2.515517, 0.802853, 0.010328
+    d1, d2, d3 = 1.432788, 0.189269, 0.001308
+    # Exceedance probability, folded to the lower half
+    p = 1 - prob
+    pf = np.where( p > 0.5, 1 - p, p )
+    with np.errstate( invalid='ignore', divide='ignore' ):
+        w = np.sqrt( -2 * np.log( pf ))
+        z = w - ( c0 + c1 * w + c2 * w ** 2 ) / (
+                1 + d1 * w + d2 * w ** 2 + d3 * w ** 3 )
+    z = np.where( p > 0.5, -z, z )
+    z[ ~np.isfinite( z ) ] = np.nan
+    return z